@@ -0,0 +1,374 @@
+"""Performance benchmarks for the dashboard's hot paths on synthetic cubes.
+
+    python benchmark.py --shape 512 512 128 --dtype uint16 --interleave bsq -o bench.json
+
+Writes a synthetic cube in every supported format, then times load_data,
+normalize_image / enhance_image and the load_hsi_data, update_image,
+update_spectral_plot and apply_orientation callbacks called directly.
+The callbacks are timed for eager and lazy loads, and update_image also in
+every rendering mode. Every operation runs in a fresh process so peak RSS
+is its own. Results are written as JSON: latency, peak RSS and callback
+response bytes.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import copy_context
+
+import dash
+import h5py
+import numpy as np
+import plotly
+import rasterio
+import scipy.io
+import spectral.io as spio
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+from rasterio.windows import Window
+
+import dashboard
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+FORMATS = ('npy', 'mat', 'mat73', 'hdr', 'tif', 'raw', 'hsd')
+OPERATIONS = ('load_data', 'load_data_lazy', 'load_hsi_data_cold', 'load_hsi_data_warm',
+              'update_image', 'update_spectral_plot', 'apply_orientation')
+# Format independent; timed once on a band of the synthetic cube
+IMAGE_OPERATIONS = ('normalize_image', 'enhance_image')
+# Operations that go through load_hsi_data are timed once per load mode, and
+# update_image once per rendering mode as well
+LOAD_MODES = ('eager', 'lazy')
+RENDER_MODES = ('heatmap', 'png8', 'png16')
+
+# Synthetic cubes
+def synthetic_rows(start, stop, width, channels, dtype, seed=0):
+    """Rows [start, stop) of the synthetic [H, W, C] cube, scaled to dtype.
+
+    A smooth scene of mixed materials with distinct spectra, plus Gaussian
+    noise seeded per row, so any row range is reproducible on its own.
+    """
+    y = np.arange(start, stop, dtype=np.float64)[:, None, None]
+    x = np.arange(width, dtype=np.float64)[None, :, None]
+    wavelength = np.linspace(0, 1, channels)[None, None, :]
+    material = (np.sin(y / 37.0) * np.cos(x / 53.0) + 1) / 2
+    values = 0.2 + 0.3 * material + 0.2 * np.sin(2 * np.pi * (wavelength + material))
+    noise = np.stack([np.random.default_rng((seed, row)).normal(0, 0.02, (width, channels))
+                      for row in range(start, stop)])
+    values = np.clip(values + noise, 0, 1)
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        values = np.round(values * np.iinfo(dtype).max)
+    return values.astype(dtype)
+
+def _row_blocks(shape, dtype):
+    height = shape[0]
+    rows = dashboard._chunk_rows(shape, max(8, np.dtype(dtype).itemsize))
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        yield start, stop
+
+def write_synthetic(format, directory, shape, dtype, interleave='bsq', seed=0):
+    """Write an [H, W, C] synthetic cube as format into directory.
+
+    format is a load_data format, or 'mat73' for an HDF5-based MAT file.
+    interleave picks the on-disk layout where the format has a choice
+    (NPY: bsq is [C, H, W], otherwise [H, W, C]). Returns a case dict with
+    path, format, dim_order and the RAW layout (the sample type for HSD), if any.
+    """
+    height, width, channels = shape
+    dtype = np.dtype(dtype)
+    name = os.path.join(directory, f"cube_{format}")
+    case = {'name': format, 'format': 'mat' if format == 'mat73' else format,
+            'dim_order': 'hwc', 'layout': None}
+
+    if format == 'npy':
+        case['path'] = name + '.npy'
+        if interleave == 'bsq':
+            case['dim_order'] = 'chw'
+            cube = np.lib.format.open_memmap(case['path'], mode='w+', dtype=dtype,
+                                             shape=(channels, height, width))
+            view = np.transpose(cube, (1, 2, 0))
+        else:
+            cube = view = np.lib.format.open_memmap(case['path'], mode='w+', dtype=dtype,
+                                                    shape=shape)
+        for start, stop in _row_blocks(shape, dtype):
+            view[start:stop] = synthetic_rows(start, stop, width, channels, dtype, seed)
+        cube.flush()
+    elif format == 'mat':
+        case['path'] = name + '.mat'
+        scipy.io.savemat(case['path'], {'cube': synthetic_rows(0, height, width, channels,
+                                                               dtype, seed)})
+    elif format == 'mat73':
+        case['path'] = name + '.mat'
+        # MATLAB stores arrays column-major, so the dataset is [C, W, H]
+        with h5py.File(case['path'], 'w', userblock_size=512) as f:
+            dataset = f.create_dataset('cube', shape=(channels, width, height), dtype=dtype,
+                                       chunks=(channels, min(64, width), min(64, height)))
+            for start, stop in _row_blocks(shape, dtype):
+                dataset[:, :, start:stop] = np.transpose(
+                    synthetic_rows(start, stop, width, channels, dtype, seed), (2, 1, 0))
+    elif format == 'hdr':
+        case['path'] = name + '.hdr'
+        image = spio.envi.create_image(case['path'],
+                                       metadata={'lines': height, 'samples': width,
+                                                 'bands': channels},
+                                       dtype=dtype, interleave=interleave, force=True)
+        view = image.open_memmap(interleave='bip', writable=True)
+        for start, stop in _row_blocks(shape, dtype):
+            view[start:stop] = synthetic_rows(start, stop, width, channels, dtype, seed)
+        del view
+    elif format == 'tif':
+        case['path'], case['dim_order'] = name + '.tif', 'chw'
+        with rasterio.open(case['path'], 'w', driver='GTiff', width=width, height=height,
+                           count=channels, dtype=dtype.name, tiled=True,
+                           interleave='pixel' if interleave == 'bip' else 'band') as dst:
+            for start, stop in _row_blocks(shape, dtype):
+                rows = synthetic_rows(start, stop, width, channels, dtype, seed)
+                dst.write(np.transpose(rows, (2, 0, 1)),
+                          window=Window(0, start, width, stop - start))
+    elif format in ('raw', 'hsd'):
+        case['path'] = name + '.' + format
+        if format == 'hsd':
+            interleave, offset = 'bsq', dashboard.HSD_HEADER_BYTES
+            case['layout'] = {'dtype': dtype.name}
+        else:
+            offset = 0
+            case['layout'] = {'width': width, 'height': height, 'bands': channels,
+                              'dtype': dtype.name, 'interleave': interleave}
+            with open(os.path.splitext(case['path'])[0] + '.json', 'w') as f:
+                json.dump(case['layout'], f)
+        sizes = {'height': height, 'width': width, 'bands': channels}
+        cube = np.memmap(case['path'], dtype=dtype.newbyteorder('<'), mode='w+', offset=offset,
+                         shape=tuple(sizes[axis] for axis in
+                                     dashboard.RAW_INTERLEAVE_SHAPES[interleave]))
+        # The same view open_raw() reads the file through
+        view = {'bsq': lambda: np.transpose(cube, (1, 2, 0)),
+                'bil': lambda: np.transpose(cube, (0, 2, 1)),
+                'bip': lambda: cube}[interleave]()
+        for start, stop in _row_blocks(shape, dtype):
+            view[start:stop] = synthetic_rows(start, stop, width, channels, dtype, seed)
+        cube.flush()
+        del cube, view
+        if format == 'hsd':
+            with open(case['path'], 'r+b') as f:
+                f.write(np.array([height, width, channels], dtype='<i4').tobytes())
+    else:
+        raise ValueError(f"Unsupported format: {format}")
+    return case
+
+# Measurement
+def _peak_rss():
+    """Peak resident set size of this process in bytes, or None where unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def payload_bytes(response):
+    """Size of a callback response as Dash JSON-encodes it."""
+    return len(json.dumps(response, cls=plotly.utils.PlotlyJSONEncoder))
+
+def call_callback(func, prop_id, *args):
+    """Call a Dash callback outside a request, as if prop_id had triggered it."""
+    def run():
+        context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None}]))
+        return func(*args)
+    return copy_context().run(run)
+
+def _load_callback(case, load='eager'):
+    # load_hsi_data takes the folder and the selected file name
+    return dashboard.load_hsi_data(1, os.path.dirname(case['path']), case['format'],
+                                   case['dim_order'], None, None,
+                                   ['lazy'] if load == 'lazy' else [], case['layout'],
+                                   os.path.basename(case['path']))
+
+def _check_loaded(response):
+    if response[0] is dash.no_update:
+        raise RuntimeError(response[-1])
+    return response[0]
+
+def _prepare(case, operation, band, load='eager', render_mode='heatmap'):
+    """Untimed setup; returns a function that runs one repeat of the operation."""
+    if operation in IMAGE_OPERATIONS:
+        normalized = dashboard.normalize_image(band)
+        if operation == 'normalize_image':
+            return lambda i: dashboard.normalize_image(band)
+        return lambda i: dashboard.enhance_image(normalized, 1.5, 0.1)
+    if operation == 'load_data':
+        return lambda i: dashboard.load_data(case['path'], case['format'], layout=case['layout'])
+    if operation == 'load_data_lazy':
+        return lambda i: dashboard.load_data(case['path'], case['format'], lazy=True,
+                                             layout=case['layout'])
+    if operation in ('load_hsi_data_cold', 'load_hsi_data_warm'):
+        def run(i):
+            if operation == 'load_hsi_data_cold':
+                shutil.rmtree(dashboard.CUBE_CACHE_DIR, ignore_errors=True)
+            response = _load_callback(case, load)
+            _check_loaded(response)
+            return response
+        return run
+
+    # The callbacks below need a loaded cube; the warm cache makes this cheap
+    data = _check_loaded(_load_callback(case, load))
+    height, width, channels = data['shape']
+    if operation == 'update_image':
+        # Each repeat steps to a band that has not been rendered yet
+        return lambda i: call_callback(
+            dashboard.update_image, 'next-channel.n_clicks',
+            data, i % max(1, channels - 1), None, i + 1, 'light', None, render_mode,
+            dashboard.IDENTITY_ORIENTATION, None, None, 'band', None, 1.0, 0.0)
+    if operation == 'update_spectral_plot':
+        def click(i):
+            x, y = (i * 7919) % width, (i * 104729) % height
+            return call_callback(
+                dashboard.update_spectral_plot, 'hsi-image.clickData',
+                {'points': [{'x': x, 'y': y}]}, None, None, None, 'light', data, [], None,
+                dashboard.IDENTITY_ORIENTATION, [])
+        return click
+    if operation == 'apply_orientation':
+        return lambda i: call_callback(dashboard.apply_orientation, 'rotate-90.n_clicks',
+                                       None, None, i + 1, data, dashboard.IDENTITY_ORIENTATION)
+    raise ValueError(f"Unknown operation: {operation}")
+
+def run_operation(case, operation, cache_dir, repeat, variant=None):
+    """Time one operation on one case; meant to run in a fresh process.
+
+    variant holds the 'load' mode and 'render_mode' for the operations that
+    take them (see _variants); it is copied into the result.
+    """
+    variant = variant or {}
+    dashboard.CUBE_CACHE_DIR = cache_dir
+    # Prefetching would make later steps cache hits at random
+    dashboard.PREFETCH_BANDS = 0
+    band = None
+    if operation in IMAGE_OPERATIONS:
+        cube = dashboard.standardize_cube(
+            dashboard.load_data(case['path'], case['format'], lazy=True, layout=case['layout']),
+            case['dim_order'])
+        band = np.asarray(cube[:, :, cube.shape[2] // 2], dtype=np.float32)
+
+    run = _prepare(case, operation, band, **variant)
+    rss_before = _peak_rss()
+    latencies, response = [], None
+    for i in range(repeat):
+        start = time.perf_counter()
+        response = run(i)
+        latencies.append(time.perf_counter() - start)
+    rss_after = _peak_rss()
+
+    result = {'case': case['name'], 'operation': operation, **variant, 'repeats': repeat,
+              'latency_median_s': statistics.median(latencies),
+              'latency_min_s': min(latencies),
+              'latency_max_s': max(latencies),
+              'peak_rss_bytes': rss_after,
+              'peak_rss_increase_bytes': (None if rss_after is None
+                                          else max(0, rss_after - rss_before)),
+              'payload_bytes': None}
+    if operation.startswith(('load_hsi_data', 'update_', 'apply_')):
+        result['payload_bytes'] = payload_bytes(response)
+    return result
+
+def _in_fresh_process(*args):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_operation, *args).result()
+
+def _variants(operation, load_modes=LOAD_MODES, render_modes=RENDER_MODES):
+    """Option dicts an operation is timed with."""
+    if operation == 'update_image':
+        return [{'load': load, 'render_mode': mode} for load in load_modes
+                for mode in render_modes]
+    if operation.startswith(('load_hsi_data', 'update_', 'apply_')):
+        return [{'load': load} for load in load_modes]
+    return [{}]
+
+def run_benchmarks(shape, dtype, interleave='bsq', formats=FORMATS, repeat=5, workdir=None,
+                   seed=0, load_modes=LOAD_MODES, render_modes=RENDER_MODES):
+    """Write the synthetic cubes and time every operation; returns the JSON report."""
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='hsi-bench-')
+    results = []
+    try:
+        cases = []
+        for format in formats:
+            case_dir = os.path.join(workdir, format)
+            os.makedirs(case_dir, exist_ok=True)
+            try:
+                cases.append(write_synthetic(format, case_dir, shape, dtype, interleave, seed))
+            except Exception as e:
+                results.append({'case': format, 'operation': 'write', 'error': str(e)})
+
+        jobs = [(case, operation, variant) for case in cases for operation in OPERATIONS
+                for variant in _variants(operation, load_modes, render_modes)]
+        if cases:
+            jobs = [(cases[0], operation, {}) for operation in IMAGE_OPERATIONS] + jobs
+        for case, operation, variant in jobs:
+            try:
+                result = _in_fresh_process(case, operation,
+                                           os.path.join(workdir, 'cache', case['name']), repeat,
+                                           variant)
+            except Exception as e:
+                result = {'case': case['name'], 'operation': operation, **variant,
+                          'error': str(e)}
+            if operation in IMAGE_OPERATIONS:
+                result['case'] = None
+            results.append(result)
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'config': {'shape': list(shape), 'dtype': np.dtype(dtype).name,
+                   'interleave': interleave, 'repeat': repeat, 'seed': seed,
+                   'load_modes': list(load_modes), 'render_modes': list(render_modes)},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'numpy': np.__version__,
+                        'dash': dash.__version__, 'plotly': plotly.__version__,
+                        'rasterio': rasterio.__version__, 'h5py': h5py.__version__},
+        'results': results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard on synthetic cubes")
+    parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 128],
+                        metavar=('HEIGHT', 'WIDTH', 'BANDS'))
+    parser.add_argument('--dtype', default='uint16')
+    parser.add_argument('--interleave', choices=('bsq', 'bil', 'bip'), default='bsq',
+                        help="On-disk layout for formats that have a choice")
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    parser.add_argument('--load-modes', nargs='+', choices=LOAD_MODES, default=list(LOAD_MODES),
+                        help="load_hsi_data modes the callbacks are timed with")
+    parser.add_argument('--render-modes', nargs='+', choices=RENDER_MODES,
+                        default=list(RENDER_MODES),
+                        help="Rendering modes update_image is timed with")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="Keep the synthetic cubes here instead of a temp dir")
+    parser.add_argument('-o', '--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(tuple(args.shape), args.dtype, args.interleave, tuple(args.formats),
+                            args.repeat, args.workdir, args.seed, tuple(args.load_modes),
+                            tuple(args.render_modes))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 1 if any('error' in result for result in report['results']) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,68 @@
 import dash
-from dash import dcc, html, Input, Output, State, callback, ctx
+from dash import dcc, html, Input, Output, State, callback, clientside_callback, ctx
+import flask
 import plotly.graph_objects as go
+import plotly.colors
 import numpy as np
 import scipy.io
+import scipy.linalg
 import spectral.io as spio
 import os
+import sys
 from PIL import Image
 import rasterio
 from tkinter import filedialog
 import tkinter as tk
+import argparse
 import base64
+import hashlib
 import io
+import json
+import logging
+import logging.handlers
+import math
+import threading
+import time
+import uuid
+import zipfile
 from dash.long_callback import DiskcacheLongCallbackManager
 import diskcache
+import h5py
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+try:
+    import resource
+except ImportError:  # Windows: quicklook workers run without a hard memory limit
+    resource = None
 
 cache = diskcache.Cache("./cache")
 long_callback_manager = DiskcacheLongCallbackManager(cache)
 
+# Loaded cubes live server-side; dcc.Store only carries a small handle.
+# Long callbacks run in a separate process, so each registered cube is also
+# written to CUBE_CACHE_DIR and memory-mapped back on first use elsewhere.
+# Handles of loaded files are derived from path, mtime and dim order, so the
+# standardized copy doubles as a persistent cache for the next load.
+CUBE_CACHE_DIR = os.path.join("./cache", "cubes")
+# Least recently used cubes are evicted once the directory grows past this
+CUBE_CACHE_MAX_BYTES = 20 * 1024 ** 3
+_cube_registry = {}
+_cube_registry_lock = threading.Lock()
+
+# Rows per chunk are chosen so one chunk of a cube is roughly this many bytes
+CHUNK_BYTES = 64 * 1024 * 1024
+# Pixels sampled per cube for the percentile columns of the band statistics
+STATS_SAMPLE_PIXELS = 200_000
+# Longest side of the overview used for band statistics of TIFFs with overviews
+STATS_OVERVIEW_SIZE = 2048
+
+# Longest side, in pixels, of a band image sent to the browser. Larger views
+# are served from a block-averaged pyramid level instead.
+MAX_DISPLAY_SIZE = 512
+
 # Initialize Dash app
 app = dash.Dash(__name__, suppress_callback_exceptions=True)
 
@@ -233,35 +279,488 @@ def validate_wavelength_input(start_wl, end_wl):
         return False, "Wavelengths must be positive"
     return True, ""
 
-def load_data(path, format):
+RAW_INTERLEAVE_SHAPES = {
+    'bsq': ('bands', 'height', 'width'),
+    'bil': ('height', 'bands', 'width'),
+    'bip': ('height', 'width', 'bands'),
+}
+
+def read_raw_layout(path):
+    """Layout of a RAW file from a JSON sidecar (<name>.json or <name>.raw.json).
+
+    The sidecar holds width, height, bands and optionally dtype (default
+    uint16), byte_order ('little'/'big'), interleave ('bsq'/'bil'/'bip') and
+    offset (header bytes to skip). Returns None if there is no sidecar.
+    """
+    for sidecar in (os.path.splitext(path)[0] + '.json', path + '.json'):
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                return json.load(f)
+    return None
+
+def open_raw(path, layout):
+    """Memory-map a RAW file described by layout as an [H, W, C] view."""
+    if not layout or not all(layout.get(key) for key in ('width', 'height', 'bands')):
+        raise ValueError("RAW files need width, height and bands (sidecar or RAW layout inputs)")
+    interleave = (layout.get('interleave') or 'bsq').lower()
+    if interleave not in RAW_INTERLEAVE_SHAPES:
+        raise ValueError(f"Unsupported interleave: {interleave}")
+    dtype = np.dtype(layout.get('dtype') or 'uint16').newbyteorder(
+        '>' if layout.get('byte_order') == 'big' else '<')
+    offset = int(layout.get('offset') or 0)
+    shape = tuple(int(layout[key]) for key in RAW_INTERLEAVE_SHAPES[interleave])
+
+    expected = offset + int(np.prod(shape)) * dtype.itemsize
+    if os.path.getsize(path) < expected:
+        raise ValueError(f"File is smaller than the layout requires ({expected} bytes)")
+
+    data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    if interleave == 'bsq':
+        return np.transpose(data, (1, 2, 0))
+    elif interleave == 'bil':
+        return np.transpose(data, (0, 2, 1))
+    return data
+
+class _LazyCube:
+    """Array-like 3-D view of an on-disk dataset, read block by block.
+
+    Supports integer and slice indexing plus transpose(), so it can stand in
+    for a memmapped cube. Subclasses set _source_shape and dtype and
+    implement _read_block(); axes maps view axes to source axes.
+    """
+
+    ndim = 3
+
+    def __init__(self, axes):
+        self.axes = tuple(axes)
+        self.shape = tuple(self._source_shape[axis] for axis in self.axes)
+
+    def _read_block(self, bounds):
+        """Read the source block [(start, stop)] * 3 as an array in source order."""
+        raise NotImplementedError
+
+    def transpose(self, axes):
+        raise NotImplementedError
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :, :], dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        source_key = [None] * 3
+        for axis, k in zip(self.axes, key):
+            source_key[axis] = k
+
+        # Bounding range to read per source axis, then what to pick from it
+        bounds, picks = [], []
+        for k, n in zip(source_key, self._source_shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + n if k < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError(f"Index {k} out of range for axis of size {n}")
+                bounds.append((k, k + 1))
+                picks.append(0)
+            elif isinstance(k, slice):
+                indices = range(*k.indices(n))
+                if len(indices) == 0 or indices.step == 1:
+                    bounds.append((indices.start, max(indices.start, indices.stop)))
+                    picks.append(None)
+                else:
+                    low = min(indices)
+                    bounds.append((low, max(indices) + 1))
+                    picks.append(np.array(indices) - low)
+            else:
+                raise TypeError(f"{type(self).__name__} supports integer and slice indexing only")
+
+        if any(stop <= start for start, stop in bounds):
+            data = np.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+        else:
+            data = self._read_block(bounds)
+        for axis in (2, 1, 0):
+            if isinstance(picks[axis], np.ndarray):
+                data = np.take(data, picks[axis], axis=axis)
+            elif picks[axis] == 0:
+                data = np.take(data, 0, axis=axis)
+
+        # Reorder the remaining source axes into view order
+        remaining = [axis for axis in range(3) if not isinstance(source_key[axis], (int, np.integer))]
+        wanted = [axis for axis in self.axes if axis in remaining]
+        return np.transpose(data, [remaining.index(axis) for axis in wanted])
+
+class RasterioCube(_LazyCube):
+    """Lazy [bands, rows, cols] view of a raster read through rasterio windows.
+
+    With factor > 1 the view is the raster at 1/factor resolution: each read
+    averages factor x factor source pixels, which GDAL serves from the
+    file's overviews when it has them.
+    """
+
+    def __init__(self, path, axes=(0, 1, 2), factor=1):
+        self.path = path
+        self.factor = factor
+        self._src = rasterio.open(path)
+        self._lock = threading.Lock()
+        self._source_shape = (self._src.count, -(-self._src.height // factor),
+                              -(-self._src.width // factor))
+        self.dtype = np.dtype(self._src.dtypes[0])
+        super().__init__(axes)
+
+    def transpose(self, axes):
+        return RasterioCube(self.path, [self.axes[axis] for axis in axes], self.factor)
+
+    def decimated(self, factor):
+        """The same view at 1/factor resolution, still read lazily."""
+        return RasterioCube(self.path, self.axes, self.factor * factor)
+
+    def _read_block(self, bounds):
+        (b0, b1), (r0, r1), (c0, c1) = bounds
+        indexes = list(range(b0 + 1, b1 + 1))
+        with self._lock:
+            if self.factor == 1:
+                return self._src.read(indexes, window=Window(c0, r0, c1 - c0, r1 - r0))
+            # Edge blocks cover fewer source pixels, as in read_decimated()
+            f = self.factor
+            window = Window(c0 * f, r0 * f, min(c1 * f, self._src.width) - c0 * f,
+                            min(r1 * f, self._src.height) - r0 * f)
+            return self._src.read(indexes, window=window,
+                                  out_shape=(len(indexes), r1 - r0, c1 - c0),
+                                  resampling=Resampling.average)
+
+    def has_band_overviews(self):
+        """True if bands are a source axis and the file has internal overviews."""
+        return self.axes[2] == 0 and bool(self._src.overviews(1))
+
+    def read_decimated(self, factor, channel=None):
+        """[H, W, C] cube, or one [H, W] band, at 1/factor resolution.
+
+        GDAL serves these reads from the file's overviews when it has them.
+        Only valid when has_band_overviews() is True.
+        """
+        rows, cols = -(-self._src.height // factor), -(-self._src.width // factor)
+        indexes = list(range(1, self._src.count + 1)) if channel is None else [channel + 1]
+        with self._lock:
+            data = self._src.read(indexes, out_shape=(len(indexes), rows, cols),
+                                  resampling=Resampling.average)
+        data = np.transpose(data, self.axes)
+        return data if channel is None else data[:, :, 0]
+
+class H5Cube(_LazyCube):
+    """Lazy view of a 3-D HDF5 dataset (MATLAB v7.3 variables, cached cubes).
+
+    Reads are plain h5py slices, so only the chunks covering a band or pixel
+    come off disk. MATLAB stores arrays column-major; open its variables
+    with axes=(2, 1, 0) to get the shape loadmat() would.
+    """
+
+    def __init__(self, path, name, axes=(0, 1, 2)):
+        self.path = path
+        self.name = name
+        self._file = h5py.File(path, 'r')
+        self._dataset = self._file[name]
+        self._lock = threading.Lock()
+        self._source_shape = self._dataset.shape
+        self.dtype = self._dataset.dtype
+        super().__init__(axes)
+
+    def transpose(self, axes):
+        return H5Cube(self.path, self.name, [self.axes[axis] for axis in axes])
+
+    def _read_block(self, bounds):
+        with self._lock:
+            return self._dataset[tuple(slice(start, stop) for start, stop in bounds)]
+
+class BandSubsetCube(_LazyCube):
+    """Lazy [H, W, K] view of bands [start, stop) of an [H, W, C] cube.
+
+    With binning > 1 every group of binning adjacent bands is averaged (the
+    last group may be smaller). Reads only touch the source bands behind
+    the requested output bands.
+    """
+
+    def __init__(self, data, start, stop, binning=1, axes=(0, 1, 2)):
+        self.data = data
+        self.start, self.stop, self.binning = start, stop, binning
+        self._source_shape = tuple(data.shape[:2]) + (-(-(stop - start) // binning),)
+        self.dtype = (np.dtype(data.dtype) if binning == 1
+                      else np.result_type(data.dtype, np.float32))
+        super().__init__(axes)
+
+    def transpose(self, axes):
+        return BandSubsetCube(self.data, self.start, self.stop, self.binning,
+                              [self.axes[axis] for axis in axes])
+
+    def _read_block(self, bounds):
+        (r0, r1), (c0, c1), (k0, k1) = bounds
+        b0 = self.start + k0 * self.binning
+        b1 = min(self.start + k1 * self.binning, self.stop)
+        block = np.asarray(self.data[r0:r1, c0:c1, b0:b1])
+        if self.binning == 1:
+            return block
+        edges = np.arange(0, b1 - b0, self.binning)
+        counts = np.diff(np.append(edges, b1 - b0))
+        sums = np.add.reduceat(block, edges, axis=2, dtype=np.float64)
+        return (sums / counts).astype(self.dtype)
+
+class StridedCube(_LazyCube):
+    """Lazy view of every step-th row and column of an [H, W, C] cube.
+
+    Reads only touch the sampled rows of the source.
+    """
+
+    def __init__(self, data, step, axes=(0, 1, 2)):
+        self.data = data
+        self.step = step
+        height, width, channels = data.shape
+        self._source_shape = (-(-height // step), -(-width // step), channels)
+        self.dtype = np.dtype(data.dtype)
+        super().__init__(axes)
+
+    def transpose(self, axes):
+        return StridedCube(self.data, self.step, [self.axes[axis] for axis in axes])
+
+    def _read_block(self, bounds):
+        (r0, r1), (c0, c1), (k0, k1) = bounds
+        step = self.step
+        return np.stack([np.asarray(self.data[row * step, c0 * step:c1 * step:step, k0:k1])
+                         for row in range(r0, r1)])
+
+def strided_sample(data, pixels=None):
+    """Every step-th row and column of an [H, W, C] cube, with step chosen
+    so that about pixels (default STATS_SAMPLE_PIXELS) pixels remain. Arrays
+    (and memmaps) are sliced; other lazy cubes are wrapped in a StridedCube.
+    """
+    height, width = data.shape[:2]
+    step = max(1, math.ceil(math.sqrt(height * width / (pixels or STATS_SAMPLE_PIXELS))))
+    if step == 1:
+        return data
+    if isinstance(data, np.ndarray):
+        return data[::step, ::step]
+    return StridedCube(data, step)
+
+def subset_bands(data, start, stop, binning=1):
+    """Bands [start, stop) of an [H, W, C] cube, averaged in groups of binning.
+
+    Unbinned subsets of arrays are plain slices, so memmapped cubes stay
+    memmaps and only the selected bands are ever read; everything else is
+    wrapped in a BandSubsetCube.
+    """
+    if binning == 1 and (start, stop) == (0, data.shape[2]):
+        return data
+    if binning == 1 and isinstance(data, np.ndarray):
+        return data[:, :, start:stop]
+    return BandSubsetCube(data, start, stop, binning)
+
+def list_mat_variables(path):
+    """List (name, shape) for every array in a MAT file without loading data.
+
+    Handles v5 files through scipy.io.whosmat and v7.3 (HDF5) files through
+    h5py; v7.3 shapes are reported in MATLAB order.
+    """
+    if not h5py.is_hdf5(path):
+        return [(name, tuple(shape)) for name, shape, _ in scipy.io.whosmat(path)]
+
+    variables = []
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and not name.startswith('#'):
+            variables.append((name, tuple(reversed(obj.shape))))
+    with h5py.File(path, 'r') as f:
+        f.visititems(visit)
+    return variables
+
+def build_tiff_overviews(path, min_size=256):
+    """Build internal average overviews (2x, 4x, ...) for a TIFF that has none.
+
+    Returns False if the file cannot be opened for writing.
+    """
+    try:
+        with rasterio.open(path, 'r+') as dst:
+            if dst.overviews(1):
+                return True
+            factors = []
+            factor = 2
+            while max(dst.width, dst.height) / factor >= min_size:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                dst.build_overviews(factors, Resampling.average)
+        return True
+    except rasterio.errors.RasterioError:
+        return False
+
+HSD_HEADER_BYTES = 12
+# Sample types assumed from the payload size; 4- and 8-byte payloads could
+# be integers or floats, so those need an explicit dtype
+HSD_SAMPLE_DTYPES = {1: 'uint8', 2: 'uint16'}
+
+@lru_cache(maxsize=128)
+def _hsd_layout(path, mtime, dtype=None):
+    with open(path, 'rb') as f:
+        header = np.frombuffer(f.read(HSD_HEADER_BYTES), dtype='<i4')
+    if header.size != 3 or np.any(header <= 0):
+        raise ValueError("Invalid HSD header")
+    height, width, bands = (int(v) for v in header)
+    payload = os.path.getsize(path) - HSD_HEADER_BYTES
+    itemsize, remainder = divmod(payload, height * width * bands)
+    if remainder or itemsize == 0:
+        raise ValueError(f"HSD payload of {payload} bytes does not match "
+                         f"{height}x{width}x{bands} samples")
+    if dtype is None:
+        if itemsize not in HSD_SAMPLE_DTYPES:
+            raise ValueError(f"HSD samples are {itemsize} bytes, which could be an integer "
+                             f"or a float type; choose the sample type explicitly")
+        dtype = HSD_SAMPLE_DTYPES[itemsize]
+    elif np.dtype(dtype).itemsize != itemsize:
+        raise ValueError(f"HSD samples are {itemsize} bytes, but {dtype} samples "
+                         f"are {np.dtype(dtype).itemsize}")
+    return {'width': width, 'height': height, 'bands': bands,
+            'dtype': dtype, 'byte_order': 'little',
+            'interleave': 'bsq', 'offset': HSD_HEADER_BYTES}
+
+def read_hsd_header(path, dtype=None):
+    """Layout of an HSD capture, parsed once per file version.
+
+    The header is three little-endian int32 values (height, width, bands)
+    followed by a band-sequential payload. The sample type is dtype if
+    given; otherwise 1- and 2-byte samples are read as uint8 and uint16 and
+    wider ones raise, since their size alone does not say int or float.
+    A JSON sidecar (see read_raw_layout) takes precedence for captures
+    written with a different layout.
+    """
+    return read_raw_layout(path) or _hsd_layout(os.path.abspath(path), os.path.getmtime(path),
+                                                dtype)
+
+def load_data(path, format, lazy=False, layout=None):
+    """Load a cube from path.
+
+    With lazy=True, NPY and ENVI files are memory-mapped, TIFF files are
+    opened as a RasterioCube and MATLAB v7.3 files as an H5Cube instead of
+    read into RAM, so band slices and pixel spectra are only read from disk
+    on access. MAT files only load their largest 3-D variable.
+    RAW files are always memory-mapped as [H, W, C], using the sidecar layout
+    if there is one and layout otherwise (see read_raw_layout). HSD captures
+    are memory-mapped the same way from their own header, with the sample
+    type from layout['dtype'] if given (see read_hsd_header).
+    """
     try:
         if not os.path.exists(path):
             raise FileNotFoundError(f"File not found: {path}")
 
         if format == 'npy':
-            data = np.load(path, allow_pickle=True)
+            data = None
+            if lazy:
+                try:
+                    data = np.load(path, mmap_mode='r')
+                except ValueError:
+                    # Object arrays cannot be memory-mapped
+                    data = None
+            if data is None:
+                data = np.load(path, allow_pickle=True)
             if not isinstance(data, np.ndarray):
                 raise ValueError("Loaded NPY file does not contain a numpy array")
             return data
         elif format == 'mat':
-            mat_data = scipy.io.loadmat(path)
-            return max((v for k, v in mat_data.items()
-                       if isinstance(v, np.ndarray) and len(v.shape) == 3),
-                      key=lambda x: x.size)
+            name, _ = _largest_mat_variable(path)
+            if h5py.is_hdf5(path):
+                data = H5Cube(path, name, axes=(2, 1, 0))
+                return data if lazy else np.asarray(data)
+            return scipy.io.loadmat(path, variable_names=[name])[name]
         elif format == 'hdr':
+            if lazy:
+                return spio.envi.open(path).open_memmap(interleave='bip')
             return spio.envi.open(path).load()
         elif format == 'tif':
+            if lazy:
+                return RasterioCube(path)
             with rasterio.open(path) as src:
                 return src.read()
+        elif format == 'raw':
+            return open_raw(path, read_raw_layout(path) or layout)
+        elif format == 'hsd':
+            return open_raw(path, read_hsd_header(path, (layout or {}).get('dtype')))
         else:
             raise ValueError(f"Unsupported file format: {format}")
     except Exception as e:
         raise Exception(f"Error loading {format} file: {str(e)}")
 
-def normalize_image(image_data):
-    """Normalize image data to [0, 1] range."""
-    min_val = np.min(image_data)
-    max_val = np.max(image_data)
+def source_band_count(path, format, dim_order, layout=None):
+    """Number of bands of a cube file, read from its header or a lazy open."""
+    dim_order = format_dim_order(format, dim_order)
+    if format == 'mat' and not h5py.is_hdf5(path):
+        _, shape = _largest_mat_variable(path)
+    else:
+        shape = load_data(path, format, lazy=True, layout=layout).shape
+    return shape[0] if dim_order in ('chw', 'cwh') else shape[2]
+
+def _largest_mat_variable(path):
+    """Name and shape of the largest 3-D variable in a MAT file, without
+    loading data."""
+    candidates = [(name, shape) for name, shape in list_mat_variables(path)
+                  if len(shape) == 3]
+    if not candidates:
+        raise ValueError("MAT file does not contain a 3-D array")
+    return max(candidates, key=lambda v: np.prod(v[1]))
+
+def _slice_band(data, dim_order, index):
+    """Slice one band out of an array-like in its on-disk dim order."""
+    if dim_order == 'chw':
+        return np.asarray(data[index, :, :])
+    elif dim_order == 'cwh':
+        return np.asarray(data[index, :, :]).T
+    elif dim_order == 'hwc':
+        return np.asarray(data[:, :, index])
+    return np.asarray(data[:, :, index]).T  # whc
+
+def read_band(path, format, dim_order, index=0, layout=None):
+    """Read a single band as a 2-D [H, W] array without loading the cube."""
+    dim_order = format_dim_order(format, dim_order)
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File not found: {path}")
+
+        if format in ('npy', 'hdr', 'raw', 'hsd'):
+            return _slice_band(load_data(path, format, lazy=True, layout=layout),
+                               dim_order, index)
+        elif format == 'tif':
+            # rasterio arrays are [bands, rows, cols]
+            with rasterio.open(path) as src:
+                if dim_order in ('chw', 'cwh'):
+                    band = src.read(index + 1)
+                else:
+                    band = src.read(window=Window(index, 0, 1, src.height))[:, :, 0]
+            return band.T if dim_order in ('cwh', 'whc') else band
+        elif format == 'mat':
+            if h5py.is_hdf5(path):
+                return _slice_band(load_data(path, format, lazy=True), dim_order, index)
+            name, _ = _largest_mat_variable(path)
+            data = scipy.io.loadmat(path, variable_names=[name])[name]
+            return _slice_band(data, dim_order, index)
+        return _slice_band(load_data(path, format), dim_order, index)
+    except Exception as e:
+        raise Exception(f"Error reading band from {format} file: {str(e)}")
+
+@lru_cache(maxsize=32)
+def _preview_band(path, mtime, format, dim_order, layout_key=None):
+    # mtime is part of the key so edited files are re-read; layout_key is
+    # the RAW/HSD layout as JSON so it can be hashed
+    layout = json.loads(layout_key) if layout_key else None
+    band = read_band(path, format, dim_order, 0, layout=layout)
+    factor = _level_for_size(band.shape[1], band.shape[0])
+    if factor > 1:
+        band = _downsample_mean(band, factor)
+    return normalize_image(band), factor
+
+def normalize_image(image_data, min_val=None, max_val=None):
+    """Normalize image data to [0, 1] range.
+
+    min_val/max_val default to the range of image_data; pass the full band's
+    range when normalizing a crop or pyramid level so the contrast matches.
+    """
+    if min_val is None:
+        min_val = np.min(image_data)
+    if max_val is None:
+        max_val = np.max(image_data)
     if max_val == min_val:
         return np.zeros_like(image_data)
     return (image_data - min_val) / (max_val - min_val)
@@ -271,6 +770,1680 @@ def enhance_image(image_data, contrast=1.0, brightness=0.0):
     enhanced = image_data * contrast + brightness
     return np.clip(enhanced, 0, 1)
 
+def enhancement_range(contrast=1.0, brightness=0.0):
+    """zmin/zmax that make a [0, 1] grayscale heatmap render like enhance_image."""
+    return -brightness / contrast, (1 - brightness) / contrast
+
+# Dim order the dashboard and the quicklook CLI assume unless told otherwise
+DEFAULT_DIM_ORDER = 'chw'
+
+def format_dim_order(format, dim_order):
+    """Dim order to read a cube of this format with: the RAW and HSD
+    readers already return [H, W, C], whatever the UI says."""
+    return 'hwc' if format in ('raw', 'hsd') else dim_order
+
+def standardize_cube(data, dim_order):
+    """Return a view of data in [H, W, C] order."""
+    if dim_order == 'chw':
+        return np.transpose(data, (1, 2, 0))
+    elif dim_order == 'cwh':
+        return np.transpose(data, (2, 1, 0))
+    elif dim_order == 'whc':
+        return np.transpose(data, (1, 0, 2))
+    return data
+
+def _chunk_rows(shape, itemsize):
+    """Number of [H, W, C] rows that fit in CHUNK_BYTES."""
+    return max(1, CHUNK_BYTES // max(1, int(np.prod(shape[1:])) * itemsize))
+
+class _BandAccumulator:
+    """Running per-band min, max, mean and std over [N, C] pixel blocks.
+
+    Blocks are reduced in their own dtype; only the sums accumulate in
+    float64. Every stride-th pixel, counted across blocks, is kept in the
+    cube's dtype for percentile estimates.
+    """
+    def __init__(self, channels, stride=1):
+        self.stride = stride
+        self.count = 0
+        self.min = np.full(channels, np.inf)
+        self.max = np.full(channels, -np.inf)
+        self.total = np.zeros(channels)
+        self.total_sq = np.zeros(channels)
+        self.samples = []
+
+    def add(self, pixels):
+        self.min = np.minimum(self.min, pixels.min(axis=0))
+        self.max = np.maximum(self.max, pixels.max(axis=0))
+        self.total += pixels.sum(axis=0, dtype=np.float64)
+        self.total_sq += np.einsum('ij,ij->j', pixels, pixels, dtype=np.float64)
+        # Copied so the block itself can be freed
+        self.samples.append(pixels[(-self.count) % self.stride::self.stride].copy())
+        self.count += len(pixels)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(self.total_sq / self.count - np.square(self.mean), 0))
+
+    def percentiles(self, q):
+        """[len(q), C] percentiles of the kept sample, reduced one band at a time."""
+        sample = np.concatenate(self.samples)
+        # Drop the pieces so the sample is only held once
+        self.samples = [sample]
+        return np.array([np.percentile(sample[:, band], q)
+                         for band in range(sample.shape[1])]).T
+
+def compute_band_stats(data):
+    """Per-band statistics of an [H, W, C] cube in one chunked pass.
+
+    Returns a dict of length-C arrays: min, max, mean, std, p1 and p99. The
+    percentiles are estimated from an evenly strided sample of at most
+    STATS_SAMPLE_PIXELS pixels, kept in the cube's dtype and reduced one band
+    at a time, so memory stays bounded for memmapped cubes.
+    """
+    height, width, channels = data.shape
+    stride = max(1, -(-height * width // STATS_SAMPLE_PIXELS))
+    # Sized for float64: the sums are accumulated at that precision
+    rows = _chunk_rows(data.shape, 8)
+
+    stats = _BandAccumulator(channels, stride)
+    for start in range(0, height, rows):
+        stats.add(np.asarray(data[start:start + rows]).reshape(-1, channels))
+
+    p1, p99 = stats.percentiles([1, 99])
+    return {'min': stats.min, 'max': stats.max, 'mean': stats.mean, 'std': stats.std,
+            'p1': p1, 'p99': p99}
+
+# Server-side cube registry
+def _cube_file(handle):
+    return os.path.join(CUBE_CACHE_DIR, f"{handle}.npy")
+
+def _cube_h5_file(handle):
+    return os.path.join(CUBE_CACHE_DIR, f"{handle}.h5")
+
+def _cube_meta_file(handle):
+    return os.path.join(CUBE_CACHE_DIR, f"{handle}.json")
+
+def _cube_stats_file(handle):
+    return os.path.join(CUBE_CACHE_DIR, f"{handle}.stats.npz")
+
+def _cube_bip_file(handle):
+    return os.path.join(CUBE_CACHE_DIR, f"{handle}.bip.npy")
+
+def _cube_transform_file(handle, method):
+    return os.path.join(CUBE_CACHE_DIR, f"{handle}.{method}.npz")
+
+def cube_cache_key(path, format, dim_order, layout=None, bands=None, load_options=None):
+    """Handle for a source file; it changes whenever the file is modified.
+
+    bands is the load-time band subset ({'start', 'stop', 'binning'}), if any.
+    load_options are the 'lazy'/'compress' options, which decide how the
+    cube is stored.
+    """
+    files = [os.path.abspath(path)]
+    if format == 'hdr':
+        files.append(os.path.abspath(spio.envi.open(path).filename))
+    stamp = [(file, os.path.getmtime(file), os.path.getsize(file)) for file in files]
+    storage = sorted(set(load_options or []) & {'lazy', 'compress'})
+    key = json.dumps([stamp, format, dim_order, layout] + ([bands] if bands else []) +
+                     ([storage] if storage else []),
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def _write_cube_copy(data, handle, compression=None):
+    """Write a standardized cube to the cache in row chunks.
+
+    Uncompressed copies are .npy files that are memory-mapped back;
+    compressed ones are HDF5 datasets chunked in 128x128 pixel, 8-band
+    tiles, so reading a band decompresses only the 8-band slab holding it
+    and reading a pixel only a short column of tiles.
+    """
+    height, width, channels = data.shape
+    rows = _chunk_rows(data.shape, data.dtype.itemsize)
+    path = _cube_h5_file(handle) if compression else _cube_file(handle)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        if compression:
+            with h5py.File(tmp_path, 'w') as f:
+                dataset = f.create_dataset('cube', shape=data.shape, dtype=data.dtype,
+                                           chunks=(min(128, height), min(128, width),
+                                                   min(8, channels)),
+                                           shuffle=True, compression=compression)
+                for start in range(0, height, rows):
+                    dataset[start:start + rows] = np.asarray(data[start:start + rows])
+        else:
+            copy = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=data.dtype,
+                                             shape=data.shape)
+            for start in range(0, height, rows):
+                copy[start:start + rows] = data[start:start + rows]
+            copy.flush()
+            del copy
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def register_cube(data, source=None, stats=None, handle=None, compression=None,
+                  original_shape=None):
+    """Store a standardized [H, W, C] cube server-side and return its handle.
+
+    When source is given ({'path', 'format', 'dim_order'}, the RAW 'layout'
+    and the subset_bands() 'bands' if any) the cube is a lazy view of that file, so only the
+    source description is persisted and other processes reopen the file
+    instead of reading a copy. Otherwise a copy is written, compressed with
+    the given HDF5 filter ('gzip', 'lzf') if any. stats is the
+    compute_band_stats() table, cached alongside the cube. handle defaults
+    to a random ID; pass cube_cache_key() to make the entry reusable.
+    """
+    handle = handle or uuid.uuid4().hex
+    if not isinstance(data, (np.memmap, _LazyCube)):
+        # Plain ndarray: subclasses such as spectral's ImageArray index
+        # differently (a pixel comes back as [1, 1, C])
+        data = np.asarray(data)
+    os.makedirs(CUBE_CACHE_DIR, exist_ok=True)
+    if stats is not None:
+        np.savez(_cube_stats_file(handle), **stats)
+    if source is not None:
+        storage = 'source'
+    else:
+        _write_cube_copy(data, handle, compression)
+        storage = 'h5' if compression else 'npy'
+    # Written last: an entry with a meta file is complete
+    with open(_cube_meta_file(handle), 'w') as f:
+        json.dump({'storage': storage, 'source': source,
+                   'original_shape': list(original_shape or data.shape)}, f)
+    with _cube_registry_lock:
+        _cube_registry[handle] = data
+    return handle
+
+def get_cube_meta(handle):
+    """Storage description of a cached cube, or None if there is no complete entry."""
+    try:
+        with open(_cube_meta_file(handle)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # The meta file's mtime is the entry's last use, for LRU eviction
+    try:
+        os.utime(_cube_meta_file(handle))
+    except OSError:
+        pass
+    return meta
+
+def get_cube(handle):
+    """Return the [H, W, C] cube registered under handle.
+
+    component_handle() handles return the cube's lazily projected PCA/MNF
+    components as an [H, W, K] ComponentCube.
+    """
+    base, method = split_component_handle(handle)
+    if method:
+        with _cube_registry_lock:
+            data = _cube_registry.get(handle)
+        if data is None:
+            data = ComponentCube(get_cube(base), get_spectral_transform(base, method))
+            with _cube_registry_lock:
+                _cube_registry[handle] = data
+        return data
+
+    with _cube_registry_lock:
+        data = _cube_registry.get(handle)
+        if data is None:
+            meta = get_cube_meta(handle)
+            if meta is None:
+                raise KeyError(f"Unknown cube handle: {handle}")
+            if meta['storage'] == 'npy':
+                data = np.load(_cube_file(handle), mmap_mode='r')
+            elif meta['storage'] == 'h5':
+                data = H5Cube(_cube_h5_file(handle), 'cube')
+            else:
+                source = meta['source']
+                data = standardize_cube(
+                    load_data(source['path'], source['format'], lazy=True,
+                              layout=source.get('layout')),
+                    source['dim_order'])
+                if source.get('bands'):
+                    data = subset_bands(data, **source['bands'])
+            _cube_registry[handle] = data
+        return data
+
+def release_cube(handle):
+    """Drop a cube from the registry and remove its cached files."""
+    components = [component_handle(handle, method) for method in SPECTRAL_TRANSFORMS]
+    with _cube_registry_lock:
+        for key in [handle] + components:
+            _cube_registry.pop(key, None)
+    with _spectrum_cache_lock:
+        _spectrum_cache.pop(handle, None)
+    files = [_cube_meta_file(handle), _cube_file(handle), _cube_h5_file(handle),
+             _cube_stats_file(handle), _cube_bip_file(handle)]
+    files += [_cube_transform_file(handle, method) for method in SPECTRAL_TRANSFORMS]
+    files += [_cube_stats_file(component) for component in components]
+    for file in files:
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+def evict_cube_cache(max_bytes=CUBE_CACHE_MAX_BYTES, keep=()):
+    """Remove least recently used cubes until CUBE_CACHE_DIR fits in max_bytes."""
+    entries = {}  # handle -> [bytes, last use]
+    with os.scandir(CUBE_CACHE_DIR) as files:
+        for file in files:
+            handle = file.name.split('.', 1)[0]
+            entry = entries.setdefault(handle, [0, 0.0])
+            stat = file.stat()
+            entry[0] += stat.st_size
+            if file.name == f"{handle}.json":
+                entry[1] = stat.st_mtime
+
+    total = sum(size for size, _ in entries.values())
+    for handle, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        if handle in keep:
+            continue
+        release_cube(handle)
+        total -= size
+
+@lru_cache(maxsize=32)
+def get_band_stats(handle):
+    """Per-band statistics table of a registered cube (see compute_band_stats)."""
+    if os.path.exists(_cube_stats_file(handle)):
+        with np.load(_cube_stats_file(handle)) as stats:
+            return {key: stats[key] for key in stats.files}
+    stats = compute_band_stats(get_cube(handle))
+    np.savez(_cube_stats_file(handle), **stats)
+    return stats
+
+# Folder index: per-file metadata and thumbnails, cached in diskcache by mtime
+THUMBNAIL_SIZE = 64
+# (folder, format, dim_order, layout JSON) -> {'files': [...], 'done': bool}
+_folder_indexes = {}
+_folder_indexes_lock = threading.Lock()
+
+def find_data_file(path, format, selected=None):
+    """File to open for a selected path: the chosen file, or the first match in a folder."""
+    if not os.path.isdir(path):
+        return path
+    if selected and os.path.isfile(os.path.join(path, selected)):
+        return os.path.join(path, selected)
+    files = sorted(f for f in os.listdir(path) if f.endswith(f'.{format}'))
+    if not files:
+        raise Exception(f"No .{format} files found in directory")
+    return os.path.join(path, files[0])
+
+def describe_file(path, format, dim_order, layout=None):
+    """Metadata of one cube without loading it: shape, dtype, interleave,
+    wavelengths and a small PNG thumbnail of the first band."""
+    meta = {'name': os.path.basename(path), 'shape': None, 'dtype': None,
+            'interleave': None, 'wavelengths': None, 'thumbnail': None, 'error': None}
+    try:
+        if format == 'mat' and not h5py.is_hdf5(path):
+            meta['shape'] = list(_largest_mat_variable(path)[1])
+        else:
+            data = load_data(path, format, lazy=True, layout=layout)
+            meta['shape'], meta['dtype'] = list(data.shape), str(data.dtype)
+
+        if format == 'hdr':
+            header = spio.envi.read_envi_header(path)
+            meta['interleave'] = header.get('interleave')
+            if 'wavelength' in header:
+                meta['wavelengths'] = [float(w) for w in header['wavelength']]
+        elif format in ('raw', 'hsd'):
+            raw_layout = (read_hsd_header(path, (layout or {}).get('dtype')) if format == 'hsd'
+                          else read_raw_layout(path) or layout)
+            meta['interleave'] = raw_layout.get('interleave')
+        elif format == 'tif':
+            with rasterio.open(path) as src:
+                meta['interleave'] = src.interleaving.name.lower() if src.interleaving else None
+
+        band = read_band(path, format, dim_order, 0, layout=layout)
+        factor = -(-max(band.shape) // THUMBNAIL_SIZE)
+        if factor > 1:
+            band = _downsample_mean(band, factor)
+        meta['thumbnail'] = encode_png(normalize_image(band))
+    except Exception as e:
+        meta['error'] = str(e)
+    return meta
+
+def _index_folder(key):
+    folder, format, dim_order, layout_key = key
+    layout = json.loads(layout_key)
+    files = []
+    with os.scandir(folder) as entries:
+        paths = sorted(entry.path for entry in entries
+                       if entry.is_file() and entry.name.endswith(f'.{format}'))
+    for path in paths:
+        mtime = os.path.getmtime(path)
+        cache_key = f"hsi-index:{os.path.abspath(path)}:{format}:{dim_order}:{layout_key}"
+        cached = cache.get(cache_key)
+        if cached is None or cached['mtime'] != mtime:
+            cached = {'mtime': mtime, 'meta': describe_file(path, format, dim_order, layout)}
+            cache.set(cache_key, cached)
+        files.append(cached['meta'])
+        with _folder_indexes_lock:
+            _folder_indexes[key]['files'] = list(files)
+    with _folder_indexes_lock:
+        _folder_indexes[key]['done'] = True
+
+def start_folder_index(folder, format, dim_order, layout=None):
+    """Index a folder's cubes in a background thread unless it is already running."""
+    key = (os.path.abspath(folder), format, dim_order, json.dumps(layout, sort_keys=True))
+    with _folder_indexes_lock:
+        state = _folder_indexes.get(key)
+        if state is not None and not state['done']:
+            return key
+        _folder_indexes[key] = {'files': state['files'] if state else [], 'done': False}
+    threading.Thread(target=_index_folder, args=(key,), daemon=True).start()
+    return key
+
+def get_folder_index(folder, format, dim_order, layout=None):
+    """(files, done) for a folder index started with start_folder_index()."""
+    key = (os.path.abspath(folder), format, dim_order, json.dumps(layout, sort_keys=True))
+    with _folder_indexes_lock:
+        state = _folder_indexes.get(key)
+        return (list(state['files']), state['done']) if state else ([], False)
+
+# Pixel spectra
+_spectrum_cache = {}  # handle -> BIP memmap, or None while it is being built
+_spectrum_cache_lock = threading.Lock()
+
+def _is_pixel_interleaved(data):
+    """True when data[y, x, :] is a contiguous read (in RAM or on disk).
+
+    HDF5 cubes count too: a pixel read only touches the chunks covering it,
+    and a BIP copy of a compressed cache would undo the compression.
+    """
+    if isinstance(data, H5Cube):
+        return True
+    if not isinstance(data, np.ndarray):
+        return False
+    return not isinstance(data, np.memmap) or data.strides[2] == data.itemsize
+
+def _build_bip_copy(handle):
+    """Write a pixel-interleaved copy of a cube to disk, chunk by chunk."""
+    data = get_cube(handle)
+    path = _cube_bip_file(handle)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        bip = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=data.dtype,
+                                        shape=data.shape)
+        rows = _chunk_rows(data.shape, data.dtype.itemsize)
+        for start in range(0, data.shape[0], rows):
+            bip[start:start + rows] = data[start:start + rows]
+        bip.flush()
+        del bip
+        os.replace(tmp_path, path)
+        with _spectrum_cache_lock:
+            _spectrum_cache[handle] = np.load(path, mmap_mode='r')
+    except Exception:
+        with _spectrum_cache_lock:
+            _spectrum_cache.pop(handle, None)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_spectrum(handle, y, x):
+    """Spectrum of source pixel (y, x) of a registered cube, as a 1-D array.
+
+    Cubes whose band axis is not contiguous on disk (e.g. memmapped BSQ)
+    get a BIP copy built in the background on first use; until it is ready
+    the spectrum is read from the cube directly.
+    """
+    data = get_cube(handle)
+    if not _is_pixel_interleaved(data):
+        with _spectrum_cache_lock:
+            if handle not in _spectrum_cache:
+                if os.path.exists(_cube_bip_file(handle)):
+                    _spectrum_cache[handle] = np.load(_cube_bip_file(handle), mmap_mode='r')
+                else:
+                    _spectrum_cache[handle] = None
+                    threading.Thread(target=_build_bip_copy, args=(handle,),
+                                     daemon=True).start()
+            bip = _spectrum_cache[handle]
+        if bip is not None:
+            data = bip
+    return np.asarray(data[y, x, :])
+
+# View orientation: flip_y/flip_x are applied to the source band first, then
+# rot90 counter-clockwise quarter turns (np.rot90). The cube itself is never
+# reoriented; only displayed bands are, and clicks are mapped back.
+IDENTITY_ORIENTATION = {'flip_y': False, 'flip_x': False, 'rot90': 0}
+
+def _orientation_key(orientation):
+    orientation = orientation or IDENTITY_ORIENTATION
+    return (bool(orientation['flip_y']), bool(orientation['flip_x']),
+            int(orientation['rot90']) % 4)
+
+def compose_orientation(orientation, op):
+    """Orientation after applying op ('vertical-flip', 'horizontal-flip' or
+    'rotate-90') to what is currently displayed."""
+    flip_y, flip_x, rot90 = _orientation_key(orientation)
+    if op == 'rotate-90':
+        rot90 = (rot90 + 1) % 4
+    elif op in ('vertical-flip', 'horizontal-flip'):
+        # A flip after an odd number of quarter turns is the other flip
+        # before them
+        if (op == 'vertical-flip') == (rot90 % 2 == 0):
+            flip_y = not flip_y
+        else:
+            flip_x = not flip_x
+    return {'flip_y': flip_y, 'flip_x': flip_x, 'rot90': rot90}
+
+def orient_band(band, orientation):
+    """Apply a view orientation to a [H, W] or [H, W, ...] array (returns a view)."""
+    flip_y, flip_x, rot90 = _orientation_key(orientation)
+    if flip_y:
+        band = band[::-1]
+    if flip_x:
+        band = band[:, ::-1]
+    return np.rot90(band, rot90)
+
+def oriented_shape(shape, orientation):
+    """Displayed (height, width) of a source [H, W, ...] shape."""
+    return tuple(shape[:2]) if _orientation_key(orientation)[2] % 2 == 0 else (shape[1], shape[0])
+
+def to_source_coords(y, x, orientation, shape):
+    """Map displayed pixel (y, x) back to (y, x) in the source [H, W] grid."""
+    flip_y, flip_x, rot90 = _orientation_key(orientation)
+    height, width = shape[:2]
+    # Undo the quarter turns; before turn t the array is (H, W) for even t
+    for turn in range(rot90, 0, -1):
+        prev_width = width if turn % 2 == 1 else height
+        y, x = x, prev_width - 1 - y
+    if flip_y:
+        y = height - 1 - y
+    if flip_x:
+        x = width - 1 - x
+    return y, x
+
+# ROI statistics
+ROI_PERCENTILES = (5, 95)
+
+def selection_polygon(selected_data):
+    """(kind, [(x, y), ...]) for a box or lasso selection in hsi-image selectedData.
+
+    kind is 'box' or 'lasso'. Returns None for events without a region
+    (e.g. a cleared selection).
+    """
+    if not selected_data:
+        return None
+    if selected_data.get('lassoPoints'):
+        lasso = selected_data['lassoPoints']
+        return 'lasso', list(zip(lasso['x'], lasso['y']))
+    if selected_data.get('range'):
+        (x0, x1), (y0, y1) = selected_data['range']['x'], selected_data['range']['y']
+        return 'box', [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    return None
+
+def polygon_mask(ys, xs, polygon):
+    """Even-odd test of pixel centres ys[:, None], xs[None, :] against polygon [(y, x), ...]."""
+    inside = np.zeros((len(ys), len(xs)), dtype=bool)
+    py = np.array([vertex[0] for vertex in polygon], dtype=np.float64)
+    px = np.array([vertex[1] for vertex in polygon], dtype=np.float64)
+    y = ys[:, None]
+    for y0, x0, y1, x1 in zip(py, px, np.roll(py, -1), np.roll(px, -1)):
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (xs[None, :] < x_cross)
+    return inside
+
+def iter_roi_pixels(handle, kind, polygon, orientation=None, read=True):
+    """Yield (ys, xs, pixels) for the pixels inside a displayed-coordinate region.
+
+    kind and polygon come from selection_polygon(); a box keeps every pixel
+    centre inside its bounds, edges included. The region's bounding box is
+    read in row chunks of about CHUNK_BYTES. ys and xs are the source
+    coordinates of each pixel and pixels is [N, C] in the cube's dtype, or
+    None with read=False, which only maps the region without touching the cube.
+    """
+    data = get_cube(handle)
+    height, width, channels = data.shape
+    # Flips and quarter turns are affine, so mapping the vertices maps the region
+    source = [to_source_coords(y, x, orientation, data.shape) for x, y in polygon]
+    y_lo = max(int(math.ceil(min(y for y, _ in source))), 0)
+    y_hi = min(int(math.floor(max(y for y, _ in source))) + 1, height)
+    x_lo = max(int(math.ceil(min(x for _, x in source))), 0)
+    x_hi = min(int(math.floor(max(x for _, x in source))) + 1, width)
+    if y_hi <= y_lo or x_hi <= x_lo:
+        return
+
+    rows = _chunk_rows((y_hi - y_lo, x_hi - x_lo, channels), data.dtype.itemsize)
+    xs = np.arange(x_lo, x_hi)
+    for start in range(y_lo, y_hi, rows):
+        ys = np.arange(start, min(start + rows, y_hi))
+        if kind == 'box':
+            mask = np.ones((len(ys), len(xs)), dtype=bool)
+        else:
+            mask = polygon_mask(ys, xs, source)
+            if not mask.any():
+                continue
+        mask_y, mask_x = np.nonzero(mask)
+        pixels = None
+        if read:
+            chunk = np.asarray(data[ys[0]:ys[-1] + 1, x_lo:x_hi])
+            pixels = chunk.reshape(-1, channels) if kind == 'box' else chunk[mask]
+        yield ys[mask_y], xs[mask_x], pixels
+
+def compute_roi_stats(handle, kind, polygon, orientation=None):
+    """Spectral statistics of the pixels inside a displayed-coordinate region.
+
+    Pixels are read through iter_roi_pixels(), so large ROIs on memmapped
+    cubes never load the whole cube. Returns a dict with count and
+    length-C lists mean, std, min, max, p_lo and p_hi (ROI_PERCENTILES,
+    estimated from at most STATS_SAMPLE_PIXELS pixels), or None if the
+    region holds no pixel centre.
+    """
+    data = get_cube(handle)
+    channels = data.shape[2]
+    area = sum(len(ys) for ys, _, _ in iter_roi_pixels(handle, kind, polygon, orientation,
+                                                       read=False))
+    if not area:
+        return None
+
+    stats = _BandAccumulator(channels, max(1, -(-area // STATS_SAMPLE_PIXELS)))
+    for _, _, pixels in iter_roi_pixels(handle, kind, polygon, orientation):
+        stats.add(pixels)
+
+    p_lo, p_hi = stats.percentiles(ROI_PERCENTILES)
+    return {'count': stats.count, 'mean': stats.mean.tolist(), 'std': stats.std.tolist(),
+            'min': stats.min.tolist(), 'max': stats.max.tolist(),
+            'p_lo': p_lo.tolist(), 'p_hi': p_hi.tolist()}
+
+# Spectral similarity
+SIMILARITY_OPACITY = 0.6
+SIMILARITY_WORKERS = min(4, os.cpu_count() or 1)
+_SIMILARITY_COLORS = np.array(plotly.colors.sample_colorscale(
+    'Viridis', np.linspace(0, 1, 256), colortype='tuple'), dtype=np.float32)
+
+def _similarity_tile(tile, reference, metric):
+    """Spectral angle (radians) or Pearson correlation of each pixel of a tile."""
+    pixels = np.asarray(tile, dtype=np.float64).reshape(-1, tile.shape[-1])
+    dot = pixels @ reference
+    sum_sq = np.einsum('ij,ij->i', pixels, pixels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'corr':
+            # reference is centred, so pixels @ reference already equals the
+            # centred dot product; only the pixel norms need centring
+            sum_sq -= np.square(pixels.sum(axis=1)) / pixels.shape[1]
+            values = dot / np.sqrt(sum_sq * (reference @ reference))
+        else:
+            values = np.arccos(np.clip(dot / np.sqrt(sum_sq * (reference @ reference)), -1, 1))
+    return values.reshape(tile.shape[:2]).astype(np.float32)
+
+def _similarity_map(handle, metric, reference):
+    key = (handle, 'similarity', metric, reference)
+    cached = _cached_level(key)
+    if cached is not None:
+        return cached
+    data = get_cube(handle)
+    height, width, _ = data.shape
+    reference = np.array(reference, dtype=np.float64)
+    if metric == 'corr':
+        reference -= reference.mean()
+    result = np.empty((height, width), dtype=np.float32)
+    rows = max(1, _chunk_rows(data.shape, 8) // SIMILARITY_WORKERS)
+
+    def fill(start):
+        result[start:start + rows] = _similarity_tile(data[start:start + rows], reference, metric)
+
+    with ThreadPoolExecutor(max_workers=SIMILARITY_WORKERS) as pool:
+        list(pool.map(fill, range(0, height, rows)))
+
+    if metric == 'corr':
+        lo, hi = -1.0, 1.0
+    else:
+        # Stretch the angles that occur; similar pixels are bright
+        sample = result.ravel()[::max(1, result.size // STATS_SAMPLE_PIXELS)]
+        lo = 0.0
+        hi = float(np.nanpercentile(sample, 99)) if np.isfinite(sample).any() else 1.0
+    result.flags.writeable = False
+    _cache_level(key, (result, lo, hi), result.nbytes)
+    return result, lo, hi
+
+def similarity_map(handle, reference, metric='sam'):
+    """Similarity of every pixel to a reference spectrum, as an [H, W] source-grid map.
+
+    metric is 'sam' (spectral angle in radians) or 'corr' (Pearson
+    correlation). The cube is read in row tiles spread over a small thread
+    pool, so the normalized cube is never materialized. Maps are cached per
+    reference spectrum, sharing BAND_LEVEL_CACHE_BYTES with the band levels.
+    Returns (map, lo, hi), the range the overlay spans.
+    """
+    return _similarity_map(handle, metric, tuple(float(v) for v in reference))
+
+def similarity_overlay(handle, reference, metric, x0, y0, factor, shape, orientation=None):
+    """RGBA [0, 1] overlay of a similarity map matching a band view of the given shape."""
+    values, lo, hi = similarity_map(handle, reference, metric)
+    values = orient_band(values, orientation)[y0:y0 + shape[0] * factor,
+                                              x0:x0 + shape[1] * factor]
+    if factor > 1:
+        values = _downsample_mean(values, factor)
+    scaled = np.clip((values - lo) / (hi - lo if hi > lo else 1), 0, 1)
+    if metric == 'sam':
+        scaled = 1 - scaled
+    colors = _SIMILARITY_COLORS[np.round(np.nan_to_num(scaled) * 255).astype(np.uint8)]
+    alpha = np.where(np.isnan(values), 0, SIMILARITY_OPACITY)[..., None]
+    return np.concatenate([colors, alpha], axis=-1)
+
+# Spectral transforms: PCA and MNF components, browsed like bands. Components
+# of a cube live under component_handle(), so the band pyramid, statistics
+# and render cache serve them like any other registered cube.
+SPECTRAL_TRANSFORMS = ('pca', 'mnf')
+TRANSFORM_COMPONENTS = 20
+# Fits run one at a time off the request threads
+_transform_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hsi-transform')
+_transform_fits = {}  # (handle, method) -> Future of the fit
+_transform_fits_lock = threading.Lock()
+
+def component_handle(handle, method):
+    """Handle of the PCA ('pca') or MNF ('mnf') components of a registered cube."""
+    return f"{handle}.{method}"
+
+def split_component_handle(handle):
+    """(cube handle, method) of a component handle; method is None for plain cubes."""
+    base, _, method = handle.partition('.')
+    return base, method or None
+
+def fit_spectral_transform(data, method='pca', components=TRANSFORM_COMPONENTS):
+    """Principal or minimum noise fraction components of an [H, W, C] cube.
+
+    The covariance is accumulated over row chunks of about CHUNK_BYTES, so
+    memmapped and lazy cubes are never read into RAM at once. For 'mnf' the
+    noise covariance is estimated from differences of horizontally adjacent
+    pixels and components are ordered by signal-to-noise ratio instead of
+    variance. Returns a dict with mean (C,), vectors (C, K), values (K,) and
+    stats, the band statistics table of the components estimated from a
+    strided sample of at most STATS_SAMPLE_PIXELS pixels.
+    """
+    height, width, channels = data.shape
+    stride = max(1, -(-height * width // STATS_SAMPLE_PIXELS))
+    rows = _chunk_rows(data.shape, 8)
+
+    # Sums are taken around the first chunk's mean to keep them well conditioned
+    shift = None
+    total = np.zeros(channels)
+    scatter = np.zeros((channels, channels))
+    noise = np.zeros((channels, channels))
+    noise_count = 0
+    samples = []
+    for start in range(0, height, rows):
+        # A copy: the chunk is shifted in place
+        pixels = np.array(data[start:start + rows], dtype=np.float64).reshape(-1, channels)
+        if shift is None:
+            shift = pixels.mean(axis=0)
+        pixels -= shift
+        total += pixels.sum(axis=0)
+        scatter += pixels.T @ pixels
+        if method == 'mnf' and width > 1:
+            grid = pixels.reshape(-1, width, channels)
+            diff = (grid[:, 1:] - grid[:, :-1]).reshape(-1, channels)
+            noise += diff.T @ diff
+            noise_count += len(diff)
+        samples.append(pixels[(-start * width) % stride::stride])
+
+    count = height * width
+    offset = total / count
+    covariance = scatter / count - np.outer(offset, offset)
+    if method == 'mnf':
+        # A difference of two pixels carries twice the noise variance
+        noise /= max(1, 2 * noise_count)
+        noise += np.eye(channels) * 1e-6 * (np.trace(noise) / channels or 1.0)
+        values, vectors = scipy.linalg.eigh(covariance, noise)
+    else:
+        values, vectors = np.linalg.eigh(covariance)
+    order = np.argsort(values)[::-1][:min(components, channels)]
+    values, vectors = values[order], vectors[:, order]
+
+    projected = (np.concatenate(samples) - offset) @ vectors
+    p1, p99 = np.percentile(projected, [1, 99], axis=0)
+    stats = {'min': projected.min(axis=0), 'max': projected.max(axis=0),
+             'mean': projected.mean(axis=0), 'std': projected.std(axis=0),
+             'p1': p1, 'p99': p99}
+    return {'mean': shift + offset, 'vectors': vectors, 'values': values, 'stats': stats}
+
+def _fit_transform_file(handle, method):
+    path = _cube_transform_file(handle, method)
+    if os.path.exists(path):
+        return
+    transform = fit_spectral_transform(get_cube(handle), method)
+    np.savez(_cube_stats_file(component_handle(handle, method)), **transform.pop('stats'))
+    # Written last, and renamed into place: the transform file marks a
+    # complete entry
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **transform)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def spectral_transform_ready(handle, method='pca'):
+    """True if a cube's transform is on disk; otherwise start fitting it in
+    the background (once) and return False.
+
+    The error of a failed fit is raised here; the next call starts over.
+    """
+    if os.path.exists(_cube_transform_file(handle, method)):
+        return True
+    key = (handle, method)
+    with _transform_fits_lock:
+        future = _transform_fits.get(key)
+        if future is None:
+            future = _transform_fits[key] = _transform_pool.submit(_fit_transform_file,
+                                                                   handle, method)
+        elif future.done():
+            del _transform_fits[key]
+    if not future.done():
+        return False
+    future.result()
+    return True
+
+@lru_cache(maxsize=8)
+def get_spectral_transform(handle, method='pca'):
+    """fit_spectral_transform() result of a registered cube, cached on disk.
+
+    The component statistics are stored as the component handle's band
+    statistics table, so reopening a cube never repeats the pass. Waits for
+    the fit if it is not on disk yet; callbacks check
+    spectral_transform_ready() first instead.
+    """
+    while not spectral_transform_ready(handle, method):
+        with _transform_fits_lock:
+            future = _transform_fits.get((handle, method))
+        if future is not None:
+            future.result()
+    with np.load(_cube_transform_file(handle, method)) as transform:
+        return {key: transform[key] for key in transform.files}
+
+class ComponentCube(_LazyCube):
+    """Lazy [H, W, K] projection of a cube onto get_spectral_transform() components.
+
+    Reads project only the requested pixels and components, reading the
+    source cube in row chunks of about CHUNK_BYTES.
+    """
+
+    def __init__(self, data, transform, axes=(0, 1, 2)):
+        self.data = data
+        self.transform = transform
+        self._source_shape = tuple(data.shape[:2]) + (transform['vectors'].shape[1],)
+        self.dtype = np.dtype(np.float32)
+        super().__init__(axes)
+
+    def transpose(self, axes):
+        return ComponentCube(self.data, self.transform, [self.axes[axis] for axis in axes])
+
+    def _read_block(self, bounds):
+        (r0, r1), (c0, c1), (k0, k1) = bounds
+        vectors = self.transform['vectors'][:, k0:k1]
+        offset = self.transform['mean'] @ vectors
+        block = np.empty((r1 - r0, c1 - c0, k1 - k0), dtype=np.float32)
+        rows = _chunk_rows((r1 - r0, c1 - c0, self.data.shape[2]), 8)
+        for start in range(r0, r1, rows):
+            stop = min(start + rows, r1)
+            pixels = np.asarray(self.data[start:stop, c0:c1], dtype=np.float64)
+            block[start - r0:stop - r0] = pixels @ vectors - offset
+        return block
+
+# Band pyramid
+def _downsample_mean(band, factor):
+    """Block-average a 2-D band by factor; partial edge blocks use their valid pixels."""
+    h, w = band.shape
+    padded = np.pad(band.astype(np.float32), ((0, -h % factor), (0, -w % factor)),
+                    constant_values=np.nan)
+    blocks = padded.reshape(padded.shape[0] // factor, factor,
+                            padded.shape[1] // factor, factor)
+    return np.nanmean(blocks, axis=(1, 3))
+
+# Pyramid levels and similarity maps are cached up to this many bytes in
+# total, least recently used first out
+BAND_LEVEL_CACHE_BYTES = 512 * 1024 ** 2
+# (handle, channel, factor, orientation key) -> (level, bytes), and
+# (handle, 'similarity', metric, reference) -> ((map, lo, hi), bytes)
+_band_levels = OrderedDict()
+_band_levels_bytes = 0
+_band_levels_lock = threading.Lock()
+
+def _cached_level(key):
+    with _band_levels_lock:
+        if key in _band_levels:
+            _band_levels.move_to_end(key)
+            return _band_levels[key][0]
+    return None
+
+def _cache_level(key, value, nbytes):
+    global _band_levels_bytes
+    with _band_levels_lock:
+        if key not in _band_levels:
+            _band_levels[key] = (value, nbytes)
+            _band_levels_bytes += nbytes
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while _band_levels_bytes > BAND_LEVEL_CACHE_BYTES and len(_band_levels) > 1:
+            _band_levels_bytes -= _band_levels.popitem(last=False)[1][1]
+
+def _band_level(handle, channel, factor, orientation_key):
+    key = (handle, channel, factor, orientation_key)
+    level = _cached_level(key)
+    if level is not None:
+        return level
+
+    if factor == 1:
+        flip_y, flip_x, rot90 = orientation_key
+        orientation = {'flip_y': flip_y, 'flip_x': flip_x, 'rot90': rot90}
+        level = np.asarray(orient_band(get_cube(handle)[:, :, channel], orientation),
+                           dtype=np.float32)
+    elif isinstance(get_cube(handle), RasterioCube) and get_cube(handle).has_band_overviews():
+        flip_y, flip_x, rot90 = orientation_key
+        orientation = {'flip_y': flip_y, 'flip_x': flip_x, 'rot90': rot90}
+        level = np.asarray(orient_band(get_cube(handle).read_decimated(factor, channel),
+                                       orientation), dtype=np.float32)
+    else:
+        level = _downsample_mean(_band_level(handle, channel, factor // 2, orientation_key), 2)
+    level.flags.writeable = False
+    _cache_level(key, level, level.nbytes)
+    return level
+
+def get_band_level(handle, channel, factor, orientation=None):
+    """Displayed band of a registered cube, block-averaged by factor (1 = full resolution).
+
+    Levels are built lazily from the next finer level and cached per
+    orientation, up to BAND_LEVEL_CACHE_BYTES in total, so a rotate or
+    flip only costs one band. TIFF bands with
+    overviews read zoomed-out levels from the overviews instead.
+    """
+    return _band_level(handle, channel, factor, _orientation_key(orientation))
+
+def _band_range(handle, channel):
+    stats = get_band_stats(handle)
+    return float(stats['min'][channel]), float(stats['max'][channel])
+
+def _level_for_size(width, height):
+    """Smallest power-of-two factor that fits width x height into MAX_DISPLAY_SIZE."""
+    factor = 1
+    while max(width, height) > factor * MAX_DISPLAY_SIZE:
+        factor *= 2
+    return factor
+
+def _band_window(handle, channel, window=None, orientation=None):
+    """Raw band values behind the visible window; see get_band_view()."""
+    cube = get_cube(handle)
+    height, width = oriented_shape(cube.shape, orientation)
+    x_lo, x_hi, y_lo, y_hi = 0, width, 0, height
+    if window:
+        x_lo = min(max(int(math.floor(min(window['x']))), 0), width)
+        x_hi = min(max(int(math.ceil(max(window['x']))) + 1, 0), width)
+        y_lo = min(max(int(math.floor(min(window['y']))), 0), height)
+        y_hi = min(max(int(math.ceil(max(window['y']))) + 1, 0), height)
+        if x_hi <= x_lo or y_hi <= y_lo:
+            x_lo, x_hi, y_lo, y_hi = 0, width, 0, height
+
+    factor = _level_for_size(x_hi - x_lo, y_hi - y_lo)
+    if factor == 1 and (x_hi - x_lo, y_hi - y_lo) != (width, height):
+        # Zoomed in: read only the source rectangle behind the visible window
+        corners = [to_source_coords(y, x, orientation, cube.shape)
+                   for y, x in ((y_lo, x_lo), (y_hi - 1, x_hi - 1))]
+        (sy0, sx0), (sy1, sx1) = corners
+        window_data = cube[min(sy0, sy1):max(sy0, sy1) + 1,
+                           min(sx0, sx1):max(sx0, sx1) + 1, channel]
+        z = np.asarray(orient_band(window_data, orientation), dtype=np.float32)
+    else:
+        x_lo, y_lo = x_lo // factor * factor, y_lo // factor * factor
+        z = get_band_level(handle, channel, factor, orientation)[
+            y_lo // factor:-(-y_hi // factor), x_lo // factor:-(-x_hi // factor)]
+    return z, x_lo, y_lo, factor
+
+def get_band_view(handle, channel, window=None, orientation=None):
+    """Return (z, x0, y0, factor) covering the visible window of a band.
+
+    window is {'x': [lo, hi], 'y': [lo, hi]} in displayed (oriented)
+    full-resolution pixel coordinates, or None for the whole band. z is
+    normalized with the full band's range; pixel (i, j) of z covers
+    displayed pixels starting at (y0 + i * factor, x0 + j * factor).
+    """
+    z, x0, y0, factor = _band_window(handle, channel, window, orientation)
+    return normalize_image(z, *_band_range(handle, channel)), x0, y0, factor
+
+def get_rgb_view(handle, channels, window=None, orientation=None):
+    """Return (rgb, x0, y0, factor) for a false-color composite of three bands.
+
+    Like get_band_view(), but rgb is [H, W, 3] and each band is stretched
+    between its 1st and 99th percentiles from the cached stats table.
+    """
+    stats = get_band_stats(handle)
+    # Bands are read and downsampled in parallel; numpy releases the GIL for most of it
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        views = list(pool.map(lambda channel: _band_window(handle, channel, window, orientation),
+                              channels))
+    rgb = np.stack([z for z, _, _, _ in views], axis=-1)
+    lo = stats['p1'][list(channels)].astype(np.float32)
+    hi = stats['p99'][list(channels)].astype(np.float32)
+    rgb = (rgb - lo) / np.maximum(hi - lo, np.finfo(np.float32).eps)
+    _, x0, y0, factor = views[0]
+    return np.clip(rgb, 0, 1), x0, y0, factor
+
+# Red, green and blue wavelengths (nm) of the true-color preset
+TRUE_COLOR_WAVELENGTHS = (640, 550, 460)
+
+def channel_for_wavelength(wavelength, wavelength_data, num_channels):
+    """Nearest channel to a wavelength, with channels spread evenly over the range."""
+    start, end = wavelength_data['start'], wavelength_data['end']
+    if num_channels == 1 or end == start:
+        return 0
+    position = (wavelength - start) / (end - start) * (num_channels - 1)
+    return int(min(max(round(position), 0), num_channels - 1))
+
+def resolve_band_range(low, high, units, wavelength_data, num_channels):
+    """0-based [start, stop) band range from inclusive 1-based channels or wavelengths.
+
+    A missing end defaults to the first or last band.
+    """
+    if units == 'wavelength':
+        if not wavelength_data:
+            raise ValueError("A wavelength band range needs the spectral range")
+        start = 0 if low is None else channel_for_wavelength(low, wavelength_data, num_channels)
+        stop = (num_channels if high is None
+                else channel_for_wavelength(high, wavelength_data, num_channels) + 1)
+    else:
+        start = 0 if low is None else min(max(int(low) - 1, 0), num_channels - 1)
+        stop = num_channels if high is None else min(max(int(high), 1), num_channels)
+    if stop <= start:
+        raise ValueError("The band range is empty")
+    return start, stop
+
+def subset_wavelengths(wavelength_data, num_channels, start, stop, binning=1):
+    """Spectral range of a subset_bands() cube: the centres of its first and last band."""
+    wavelengths = np.linspace(wavelength_data['start'], wavelength_data['end'],
+                              num_channels)[start:stop]
+    edges = np.arange(0, len(wavelengths), binning)
+    centres = np.add.reduceat(wavelengths, edges) / np.diff(np.append(edges, len(wavelengths)))
+    return {'start': float(centres[0]), 'end': float(centres[-1])}
+
+def resolve_rgb_bands(values, units, wavelength_data, num_channels):
+    """0-based (r, g, b) channels from 1-based channel numbers or wavelengths.
+
+    Returns None while a value is missing or wavelengths are given for a
+    cube without a wavelength range.
+    """
+    if any(value is None for value in values):
+        return None
+    if units == 'wavelength':
+        if not wavelength_data:
+            return None
+        return tuple(channel_for_wavelength(value, wavelength_data, num_channels)
+                     for value in values)
+    return tuple(min(max(int(value) - 1, 0), num_channels - 1) for value in values)
+
+def quantize_image(image, bits=8):
+    """[0, 1] image as uint8 (bits=8) or uint16 (bits=16) pixels; NaNs become 0."""
+    scale, dtype = (255, np.uint8) if bits == 8 else (65535, np.uint16)
+    return np.round(np.clip(np.nan_to_num(image), 0, 1) * scale).astype(dtype)
+
+def encode_png(image, bits=8):
+    """Quantize a [0, 1] gray [H, W], RGB [H, W, 3] or RGBA [H, W, 4] image to a PNG data URI.
+
+    bits=16 is only available for gray images.
+    """
+    buffer = io.BytesIO()
+    Image.fromarray(quantize_image(image, bits)).save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+def create_band_figure(z, x0, y0, factor, theme, uirevision=None,
+                       contrast=1.0, brightness=0.0, render_mode='heatmap'):
+    """Band figure whose axes are in full-resolution pixel coordinates.
+
+    z is the normalized band, or an [H, W, 3] composite from get_rgb_view().
+    In 'heatmap' mode z is sent quantized to 8 bits (levels 0-255, recorded
+    as meta.zscale) and contrast/brightness are applied through the color
+    range, so the browser can change them without a new z matrix.
+    'png8'/'png16' send the enhanced band as a quantized PNG instead, which
+    is far smaller but only carries coordinates on hover. Composites are
+    always sent as 8-bit RGB PNGs.
+    """
+    if z.ndim == 3 or render_mode in ('png8', 'png16'):
+        trace = go.Image(
+            source=encode_png(enhance_image(z, contrast, brightness),
+                              bits=16 if render_mode == 'png16' and z.ndim == 2 else 8),
+            x0=x0 + (factor - 1) / 2,
+            dx=factor,
+            y0=y0 + (factor - 1) / 2,
+            dy=factor,
+            hovertemplate='x: %{x}<br>y: %{y}<extra></extra>'
+        )
+    else:
+        zmin, zmax = enhancement_range(contrast, brightness)
+        trace = go.Heatmap(
+            z=quantize_image(z, 8),
+            zmin=zmin * 255,
+            zmax=zmax * 255,
+            meta={'zscale': 255},
+            x0=x0 + (factor - 1) / 2,
+            dx=factor,
+            y0=y0 + (factor - 1) / 2,
+            dy=factor,
+            colorscale='Gray',
+            showscale=True,
+            hoverongaps=False
+        )
+    fig = go.Figure(data=trace)
+
+    fig.update_layout(
+        margin=dict(l=0, r=0, t=0, b=0),
+        xaxis=dict(showticklabels=False, scaleanchor="y", scaleratio=1),
+        # Image traces default to a reversed y-axis; keep row 0 at the
+        # bottom in every mode, like the heatmap
+        yaxis=dict(showticklabels=False, autorange=True),
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        # Keep the user's zoom while channels change; reset for a new cube
+        uirevision=uirevision
+    )
+    return apply_theme_to_figure(fig, theme)
+
+def _view_revision(handle, orientation):
+    """uirevision for hsi-image: zoom survives channel steps, not a new cube or rotation."""
+    return f"{handle}-{'-'.join(str(int(v)) for v in _orientation_key(orientation))}"
+
+def parse_view_window(relayout_data):
+    """Visible window from hsi-image relayoutData.
+
+    Returns {'x': [lo, hi], 'y': [lo, hi]}, None when the view was reset to
+    autorange, or dash.no_update for events that do not move the axes.
+    """
+    if not relayout_data:
+        return dash.no_update
+    if 'xaxis.autorange' in relayout_data or 'yaxis.autorange' in relayout_data:
+        return None
+    ranges = {}
+    for axis in ('x', 'y'):
+        if f'{axis}axis.range[0]' in relayout_data:
+            ranges[axis] = [relayout_data[f'{axis}axis.range[0]'],
+                            relayout_data[f'{axis}axis.range[1]']]
+        elif f'{axis}axis.range' in relayout_data:
+            ranges[axis] = list(relayout_data[f'{axis}axis.range'])
+    if len(ranges) != 2:
+        return dash.no_update
+    return ranges
+
+# Rendered band figures, keyed by everything that changes their content.
+# While the user steps through channels, the next PREFETCH_BANDS bands in
+# the direction of travel are rendered ahead on a small thread pool.
+PREFETCH_BANDS = 4
+RENDER_CACHE_SIZE = 64
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='hsi-prefetch')
+_prefetch_futures = {}  # render key -> Future
+_prefetch_lock = threading.Lock()
+
+def _render_key(handle, channel, window, orientation, theme, contrast, brightness,
+                render_mode, similarity=None):
+    return (handle, channel, json.dumps(window, sort_keys=True), _orientation_key(orientation),
+            theme, contrast, brightness, render_mode, json.dumps(similarity))
+
+def render_band(handle, channel, window=None, orientation=None, theme='light',
+                contrast=1.0, brightness=0.0, render_mode='heatmap', similarity=None):
+    """Band figure for hsi-image, served from the render cache when possible.
+
+    channel is a band index, or an (r, g, b) tuple of indices for a
+    false-color composite. similarity is the similarity-ref store
+    ({'metric', 'spectrum'}) to overlay, if any.
+    """
+    key = _render_key(handle, channel, window, orientation, theme, contrast, brightness,
+                      render_mode, similarity)
+    with _render_cache_lock:
+        if key in _render_cache:
+            _render_cache.move_to_end(key)
+            return _render_cache[key]
+
+    if isinstance(channel, tuple):
+        z, x0, y0, factor = get_rgb_view(handle, channel, window, orientation)
+    else:
+        z, x0, y0, factor = get_band_view(handle, channel, window, orientation)
+    # Components share the cube's pixel grid: same zoom, same overlay
+    cube_handle = split_component_handle(handle)[0]
+    fig = create_band_figure(z, x0, y0, factor, theme,
+                             uirevision=_view_revision(cube_handle, orientation),
+                             contrast=contrast, brightness=brightness,
+                             render_mode=render_mode)
+    if similarity:
+        overlay = similarity_overlay(cube_handle, similarity['spectrum'], similarity['metric'],
+                                     x0, y0, factor, z.shape[:2], orientation)
+        fig.add_trace(go.Image(
+            source=encode_png(overlay),
+            x0=x0 + (factor - 1) / 2,
+            dx=factor,
+            y0=y0 + (factor - 1) / 2,
+            dy=factor,
+            hoverinfo='skip'
+        ))
+    with _render_cache_lock:
+        _render_cache[key] = fig
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return fig
+
+def _prefetch_band(key, *args):
+    # Skip work that went stale between submission and start
+    with _prefetch_lock:
+        if key not in _prefetch_futures:
+            return
+    try:
+        render_band(*args)
+    finally:
+        with _prefetch_lock:
+            _prefetch_futures.pop(key, None)
+
+def prefetch_bands(handle, channel, step, num_channels, window=None, orientation=None,
+                   theme='light', contrast=1.0, brightness=0.0, render_mode='heatmap',
+                   similarity=None):
+    """Render the PREFETCH_BANDS bands after channel (step is +1 or -1) in the background.
+
+    Queued renders that are no longer wanted, e.g. after a jump, a zoom or a
+    direction change, are cancelled.
+    """
+    wanted = {}
+    for i in range(1, PREFETCH_BANDS + 1):
+        target = channel + step * i
+        if not 0 <= target < num_channels:
+            break
+        args = (handle, target, window, orientation, theme, contrast, brightness, render_mode,
+                similarity)
+        wanted[_render_key(*args)] = args
+
+    with _prefetch_lock:
+        for key in list(_prefetch_futures):
+            if key not in wanted:
+                # Running renders finish and land in the cache; pending ones are dropped
+                _prefetch_futures.pop(key).cancel()
+        for key, args in wanted.items():
+            with _render_cache_lock:
+                cached = key in _render_cache
+            if not cached and key not in _prefetch_futures:
+                _prefetch_futures[key] = _prefetch_pool.submit(_prefetch_band, key, *args)
+
+# Headless quicklooks: python dashboard.py quicklook <folder>
+QUICKLOOK_FORMATS = ('npy', 'mat', 'hsd', 'tif', 'hdr', 'raw')
+QUICKLOOK_THUMBNAIL_SIZE = 128
+QUICKLOOK_MEMORY_BYTES = 2 * 1024 ** 3
+
+def find_cubes(root, formats=QUICKLOOK_FORMATS):
+    """(path, format) of every file below root whose extension is one of formats."""
+    cubes = []
+    for folder, _, files in os.walk(root):
+        for name in files:
+            format = os.path.splitext(name)[1][1:].lower()
+            if format in formats:
+                cubes.append((os.path.join(folder, name), format))
+    return sorted(cubes)
+
+def read_band_decimated(data, channel, factor):
+    """One band of an [H, W, C] cube block-averaged by factor, read in row chunks.
+
+    Chunks hold a multiple of factor rows and about CHUNK_BYTES of band
+    data, so only the decimated band is ever held in full.
+    """
+    height, width, _ = data.shape
+    rows = max(1, CHUNK_BYTES // (width * 4 * factor)) * factor
+    return np.concatenate([_downsample_mean(np.asarray(data[start:start + rows, :, channel]), factor)
+                           for start in range(0, height, rows)])
+
+def write_png(image, path, bits=8):
+    """Save a [0, 1] image as a PNG file with row 0 at the bottom, as hsi-image shows it."""
+    Image.fromarray(quantize_image(np.flipud(image), bits)).save(path)
+
+def render_quicklook(path, format, dim_order, output_dir, layout=None, contrast=1.0,
+                     brightness=0.0, force=False):
+    """Write <name>_thumb.png, <name>_band.png and <name>_rgb.png for one cube.
+
+    The band quicklook is the middle band and the RGB quicklook uses the
+    channels of the dashboard's spread preset, both at most
+    MAX_DISPLAY_SIZE pixels on a side. Quicklooks newer than the cube are
+    kept unless force. Returns a summary dict; errors are reported in it
+    rather than raised, so one bad file does not stop a batch. outputs
+    lists the quicklooks only if they are all up to date.
+    """
+    stem = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0])
+    outputs = {kind: f"{stem}_{kind}.png" for kind in ('thumb', 'band', 'rgb')}
+    result = {'path': path, 'outputs': {}, 'skipped': False, 'error': None}
+    try:
+        mtime = os.path.getmtime(path)
+        if not force and all(os.path.exists(output) and os.path.getmtime(output) >= mtime
+                             for output in outputs.values()):
+            result.update(outputs=outputs, skipped=True)
+            return result
+
+        data = standardize_cube(load_data(path, format, lazy=True, layout=layout),
+                                format_dim_order(format, dim_order))
+        height, width, channels = data.shape
+        factor = _level_for_size(width, height)
+        bands = {}
+        for channel in (channels // 2, channels * 3 // 4, channels // 4):
+            if channel not in bands:
+                bands[channel] = read_band_decimated(data, channel, factor)
+
+        os.makedirs(output_dir, exist_ok=True)
+        band = bands[channels // 2]
+        write_png(enhance_image(normalize_image(band), contrast, brightness), outputs['band'])
+        thumb_factor = -(-max(band.shape) // QUICKLOOK_THUMBNAIL_SIZE)
+        write_png(normalize_image(_downsample_mean(band, thumb_factor) if thumb_factor > 1 else band),
+                  outputs['thumb'])
+
+        rgb = np.stack([bands[channel] for channel in
+                        (channels * 3 // 4, channels // 2, channels // 4)], axis=-1)
+        lo, hi = np.nanpercentile(rgb.reshape(-1, 3), [1, 99], axis=0)
+        rgb = np.clip((rgb - lo) / np.maximum(hi - lo, np.finfo(np.float32).eps), 0, 1)
+        write_png(enhance_image(rgb, contrast, brightness), outputs['rgb'])
+        result['outputs'] = outputs
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def _init_quicklook_worker(max_bytes):
+    global CHUNK_BYTES
+    # Chunked reads take a fraction of the budget; the rest holds the
+    # decimated bands, PNG encoding and the interpreter itself
+    CHUNK_BYTES = max(1024 ** 2, max_bytes // 8)
+    if resource is not None:
+        # RLIMIT_DATA leaves file-backed memory maps alone, so large cubes
+        # can still be memory-mapped; overruns raise MemoryError
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        soft = max_bytes if hard == resource.RLIM_INFINITY else min(max_bytes, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
+
+def run_quicklooks(root, output_dir, formats=QUICKLOOK_FORMATS, dim_order=None, layout=None,
+                   workers=None, max_bytes=QUICKLOOK_MEMORY_BYTES, contrast=1.0, brightness=0.0,
+                   force=False, hsd_dtype=None):
+    """Render quicklooks for every cube below root on a process pool.
+
+    Quicklooks mirror the folder tree under output_dir. Each worker is
+    limited to max_bytes of memory. layout applies to RAW files and
+    hsd_dtype to HSD captures. Yields render_quicklook() summaries as files
+    finish; a worker that dies (e.g. killed over its memory limit) is
+    reported as that file's error.
+    """
+    cubes = find_cubes(root, formats)
+    layouts = {'raw': layout, 'hsd': {'dtype': hsd_dtype} if hsd_dtype else None}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_quicklook_worker,
+                             initargs=(max_bytes,)) as pool:
+        futures = {pool.submit(render_quicklook, path, format,
+                               dim_order or DEFAULT_DIM_ORDER,
+                               os.path.join(output_dir, os.path.relpath(os.path.dirname(path), root)),
+                               layouts.get(format), contrast, brightness, force): path
+                   for path, format in cubes}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {'path': futures[future], 'outputs': {}, 'skipped': False,
+                       'error': str(e) or type(e).__name__}
+
+# Callback instrumentation (opt-in: python dashboard.py --metrics). Each
+# callback request is split into decode (request parsing up to the callback
+# call), compute (the callback itself) and encode (serializing the
+# response); totals are served as Prometheus text at /metrics.
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_LOG_BYTES = 10 * 1024 ** 2
+METRICS_LOG_BACKUPS = 5
+_metrics = {}  # callback name -> running totals
+_metrics_lock = threading.Lock()
+_metrics_enabled = False
+_metrics_log = None
+
+def enable_metrics(log_path=None):
+    """Start recording callback metrics; also append them as JSON lines to a
+    rotating log_path if given."""
+    global _metrics_enabled, _metrics_log
+    if log_path:
+        handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=METRICS_LOG_BYTES, backupCount=METRICS_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _metrics_log = logging.getLogger('hsi.metrics')
+        _metrics_log.setLevel(logging.INFO)
+        _metrics_log.propagate = False
+        _metrics_log.addHandler(handler)
+    _metrics_enabled = True
+
+def _current_rss():
+    """Resident set size of this process in bytes, or None without /proc."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def instrument(func):
+    """Mark the compute phase of a callback for the metrics; a no-op unless enabled."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _metrics_enabled or not flask.has_request_context():
+            return func(*args, **kwargs)
+        flask.g.hsi_callback = func.__name__
+        flask.g.hsi_compute_start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flask.g.hsi_compute_end = time.perf_counter()
+    return wrapper
+
+def record_callback_metrics(name, decode, compute, encode, request_bytes, response_bytes,
+                            rss_delta=None):
+    """Add one callback request to the totals (times in seconds)."""
+    total = decode + compute + encode
+    with _metrics_lock:
+        entry = _metrics.setdefault(name, {
+            'calls': 0, 'decode': 0.0, 'compute': 0.0, 'encode': 0.0,
+            'request_bytes': 0, 'response_bytes': 0, 'rss_delta': 0,
+            'buckets': [0] * len(METRICS_LATENCY_BUCKETS)})
+        entry['calls'] += 1
+        entry['decode'] += decode
+        entry['compute'] += compute
+        entry['encode'] += encode
+        entry['request_bytes'] += request_bytes
+        entry['response_bytes'] += response_bytes
+        entry['rss_delta'] = rss_delta
+        for i, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            if total <= bound:
+                entry['buckets'][i] += 1
+    if _metrics_log is not None:
+        _metrics_log.info(json.dumps({
+            'time': time.time(), 'callback': name, 'decode_s': decode, 'compute_s': compute,
+            'encode_s': encode, 'request_bytes': request_bytes,
+            'response_bytes': response_bytes, 'rss_delta_bytes': rss_delta}))
+
+def render_metrics():
+    """Callback totals in the Prometheus text exposition format."""
+    with _metrics_lock:
+        metrics = {name: dict(entry, buckets=list(entry['buckets']))
+                   for name, entry in _metrics.items()}
+    lines = [
+        '# HELP hsi_callback_phase_seconds_total Wall time spent per callback phase.',
+        '# TYPE hsi_callback_phase_seconds_total counter']
+    for name, entry in sorted(metrics.items()):
+        for phase in ('decode', 'compute', 'encode'):
+            lines.append(f'hsi_callback_phase_seconds_total{{callback="{name}",phase="{phase}"}} '
+                         f'{entry[phase]:.6f}')
+    lines += ['# HELP hsi_callback_seconds Wall time per callback request.',
+              '# TYPE hsi_callback_seconds histogram']
+    for name, entry in sorted(metrics.items()):
+        for bound, count in zip(METRICS_LATENCY_BUCKETS, entry['buckets']):
+            lines.append(f'hsi_callback_seconds_bucket{{callback="{name}",le="{bound}"}} {count}')
+        lines.append(f'hsi_callback_seconds_bucket{{callback="{name}",le="+Inf"}} {entry["calls"]}')
+        lines.append(f'hsi_callback_seconds_sum{{callback="{name}"}} '
+                     f'{entry["decode"] + entry["compute"] + entry["encode"]:.6f}')
+        lines.append(f'hsi_callback_seconds_count{{callback="{name}"}} {entry["calls"]}')
+    for key, help_text in (('request_bytes', 'Callback request body bytes.'),
+                           ('response_bytes', 'Callback response body bytes.')):
+        lines += [f'# HELP hsi_callback_{key}_total {help_text}',
+                  f'# TYPE hsi_callback_{key}_total counter']
+        lines += [f'hsi_callback_{key}_total{{callback="{name}"}} {entry[key]}'
+                  for name, entry in sorted(metrics.items())]
+    lines += ['# HELP hsi_callback_last_rss_delta_bytes Resident memory change during the '
+              'last request of a callback (process-wide).',
+              '# TYPE hsi_callback_last_rss_delta_bytes gauge']
+    lines += [f'hsi_callback_last_rss_delta_bytes{{callback="{name}"}} {entry["rss_delta"]}'
+              for name, entry in sorted(metrics.items()) if entry['rss_delta'] is not None]
+    rss = _current_rss()
+    if rss is not None:
+        lines += ['# HELP hsi_process_resident_memory_bytes Resident memory of the server.',
+                  '# TYPE hsi_process_resident_memory_bytes gauge',
+                  f'hsi_process_resident_memory_bytes {rss}']
+    return '\n'.join(lines) + '\n'
+
+def _is_callback_request():
+    return _metrics_enabled and flask.request.path.endswith('_dash-update-component')
+
+@app.server.before_request
+def _metrics_before_request():
+    if not _is_callback_request():
+        return
+    flask.g.hsi_start = time.perf_counter()
+    flask.g.hsi_rss_before = _current_rss()
+    # Parsed here so the cost is measured; Dash reuses Flask's cached JSON
+    body = flask.request.get_json(silent=True) or {}
+    flask.g.hsi_decoded = time.perf_counter()
+    flask.g.hsi_output = body.get('output', 'unknown')
+
+@app.server.after_request
+def _metrics_after_request(response):
+    if not _is_callback_request() or 'hsi_start' not in flask.g:
+        return response
+    end = time.perf_counter()
+    start = flask.g.hsi_start
+    if 'hsi_compute_start' in flask.g:
+        compute_start, compute_end = flask.g.hsi_compute_start, flask.g.hsi_compute_end
+    else:
+        # Not an instrumented callback (e.g. a long callback poll): all
+        # time after parsing counts as compute
+        compute_start, compute_end = flask.g.hsi_decoded, end
+    rss_before, rss_after = flask.g.hsi_rss_before, _current_rss()
+    record_callback_metrics(
+        flask.g.get('hsi_callback', flask.g.hsi_output),
+        compute_start - start, compute_end - compute_start, end - compute_end,
+        flask.request.content_length or 0,
+        0 if response.direct_passthrough else len(response.get_data()),
+        None if rss_before is None or rss_after is None else rss_after - rss_before)
+    return response
+
+@app.server.route('/metrics')
+def metrics_endpoint():
+    if not _metrics_enabled:
+        flask.abort(404)
+    return flask.Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Binary export of spectra, ROI pixels and sub-cubes. Exports are streamed
+# chunk by chunk into <token>-<filename> under EXPORT_DIR; small files go
+# through dcc.Download, larger ones are served from disk by /export/<token>.
+EXPORT_DIR = os.path.join("./cache", "exports")
+# dcc.send_file base64-encodes the whole file into the callback response
+EXPORT_INLINE_BYTES = 64 * 1024 ** 2
+EXPORT_MAX_AGE = 3600
+
+def _write_npy_member(archive, name, dtype, shape, chunks):
+    """Stream chunks (row blocks of shape) into a .npy member of an open ZipFile."""
+    dtype = np.dtype(dtype)
+    with archive.open(f"{name}.npy", 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_2_0(f, {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False,
+            'shape': tuple(shape)})
+        for chunk in chunks:
+            f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+def _spectral_axis(wavelength_data, num_channels):
+    if wavelength_data:
+        return np.linspace(wavelength_data['start'], wavelength_data['end'], num_channels)
+    return np.arange(num_channels, dtype=np.float64)
+
+def _roi_selection(region):
+    return region['type'], region['polygon'], region.get('orientation')
+
+def export_npz(path, handle, clicked_points, roi_regions, wavelength_data=None):
+    """Write clicked spectra and every ROI's pixels to an NPZ file.
+
+    Members: axis (C,), spectra (N, C) and points (N, 2) as source [y, x],
+    then roi<i>_pixels (M, C) in the cube's dtype and roi<i>_coords (M, 2)
+    for each ROI. ROI pixels are streamed from the cube in row chunks.
+    """
+    data = get_cube(handle)
+    channels = data.shape[2]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        _write_npy_member(archive, 'axis', np.float64, (channels,),
+                          [_spectral_axis(wavelength_data, channels)])
+        _write_npy_member(archive, 'spectra', np.float64, (len(clicked_points), channels),
+                          [np.array([point['spectrum'] for point in clicked_points],
+                                    dtype=np.float64).reshape(-1, channels)])
+        _write_npy_member(archive, 'points', np.int64, (len(clicked_points), 2),
+                          [np.array([point['source'] for point in clicked_points],
+                                    dtype=np.int64).reshape(-1, 2)])
+        for i, region in enumerate(roi_regions, start=1):
+            selection = _roi_selection(region)
+            count = sum(len(ys) for ys, _, _ in iter_roi_pixels(handle, *selection, read=False))
+            _write_npy_member(archive, f'roi{i}_pixels', data.dtype, (count, channels),
+                              (pixels for _, _, pixels in iter_roi_pixels(handle, *selection)))
+            _write_npy_member(archive, f'roi{i}_coords', np.int64, (count, 2),
+                              (np.stack([ys, xs], axis=1) for ys, xs, _ in
+                               iter_roi_pixels(handle, *selection, read=False)))
+
+def export_parquet(path, handle, clicked_points, roi_regions, wavelength_data=None):
+    """Write clicked spectra and every ROI's pixels as rows of a Parquet file.
+
+    Columns are region ('Point 1', 'ROI 1', ...), source y and x, then one
+    column per band; each ROI chunk becomes a row group. The spectral axis
+    is stored in the schema metadata.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    data = get_cube(handle)
+    channels = data.shape[2]
+    dtype = np.float64 if clicked_points else data.dtype.newbyteorder('=')
+    bands = [f"band_{i + 1}" for i in range(channels)]
+    schema = pa.schema([('region', pa.string()), ('y', pa.int64()), ('x', pa.int64())] +
+                       [(band, pa.from_numpy_dtype(dtype)) for band in bands],
+                       metadata={'axis': json.dumps(
+                           _spectral_axis(wavelength_data, channels).tolist())})
+
+    def table(regions, ys, xs, pixels):
+        pixels = np.asarray(pixels, dtype=dtype)
+        return pa.Table.from_arrays([pa.array(regions, pa.string()),
+                                     pa.array(ys, pa.int64()), pa.array(xs, pa.int64())] +
+                                    [pa.array(np.ascontiguousarray(pixels[:, i]))
+                                     for i in range(channels)],
+                                    schema=schema)
+
+    with pq.ParquetWriter(path, schema) as writer:
+        if clicked_points:
+            writer.write_table(table(
+                [f"Point {i + 1}" for i in range(len(clicked_points))],
+                [point['source'][0] for point in clicked_points],
+                [point['source'][1] for point in clicked_points],
+                np.array([point['spectrum'] for point in clicked_points])))
+        for i, region in enumerate(roi_regions, start=1):
+            for ys, xs, pixels in iter_roi_pixels(handle, *_roi_selection(region)):
+                writer.write_table(table([f"ROI {i}"] * len(ys), ys, xs, pixels))
+
+def export_envi(path, handle, bounds, wavelength_data=None):
+    """Write the source rectangle bounds (y0, y1, x0, x1) of a cube as a zipped
+    little-endian ENVI BIP image (.hdr + .img), streamed into the archive in
+    row chunks."""
+    data = get_cube(handle)
+    y0, y1, x0, x1 = bounds
+    channels = data.shape[2]
+    dtype = data.dtype.newbyteorder('<')
+    header = ["ENVI",
+              f"description = {{Rows {y0}-{y1 - 1}, columns {x0}-{x1 - 1} of {handle}}}",
+              f"samples = {x1 - x0}",
+              f"lines = {y1 - y0}",
+              f"bands = {channels}",
+              "header offset = 0",
+              "file type = ENVI Standard",
+              f"data type = {spio.envi.dtype_to_envi[dtype.char]}",
+              "interleave = bip",
+              "byte order = 0"]
+    if wavelength_data:
+        header.append("wavelength = {" + ", ".join(
+            f"{w:g}" for w in _spectral_axis(wavelength_data, channels)) + "}")
+    rows = _chunk_rows((y1 - y0, x1 - x0, channels), data.dtype.itemsize)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        archive.writestr('subcube.hdr', "\n".join(header) + "\n")
+        with archive.open('subcube.img', 'w', force_zip64=True) as f:
+            for start in range(y0, y1, rows):
+                f.write(np.ascontiguousarray(data[start:start + rows, x0:x1],
+                                             dtype=dtype).tobytes())
+
+def export_bounds(handle, roi_regions, window=None, orientation=None):
+    """Source rectangle (y0, y1, x0, x1) for a sub-cube export: the last ROI's
+    bounding box, else the visible window, else the whole cube."""
+    data = get_cube(handle)
+    height, width = data.shape[:2]
+    if roi_regions:
+        y0, y1, x0, x1 = height, 0, width, 0
+        for ys, xs, _ in iter_roi_pixels(handle, *_roi_selection(roi_regions[-1]), read=False):
+            y0, y1 = min(y0, int(ys.min())), max(y1, int(ys.max()) + 1)
+            x0, x1 = min(x0, int(xs.min())), max(x1, int(xs.max()) + 1)
+        if y1 > y0 and x1 > x0:
+            return y0, y1, x0, x1
+    if window:
+        shown_height, shown_width = oriented_shape(data.shape, orientation)
+        x_lo = min(max(int(math.floor(min(window['x']))), 0), shown_width - 1)
+        x_hi = min(max(int(math.ceil(max(window['x']))), 0), shown_width - 1)
+        y_lo = min(max(int(math.floor(min(window['y']))), 0), shown_height - 1)
+        y_hi = min(max(int(math.ceil(max(window['y']))), 0), shown_height - 1)
+        (sy0, sx0), (sy1, sx1) = [to_source_coords(y, x, orientation, data.shape)
+                                  for y, x in ((y_lo, x_lo), (y_hi, x_hi))]
+        return min(sy0, sy1), max(sy0, sy1) + 1, min(sx0, sx1), max(sx0, sx1) + 1
+    return 0, height, 0, width
+
+def _prune_exports():
+    """Remove exports older than EXPORT_MAX_AGE."""
+    cutoff = time.time() - EXPORT_MAX_AGE
+    with os.scandir(EXPORT_DIR) as files:
+        for file in files:
+            if file.is_file() and file.stat().st_mtime < cutoff:
+                try:
+                    os.remove(file.path)
+                except OSError:
+                    pass
+
+def write_export(export_format, handle, clicked_points, roi_regions, wavelength_data=None,
+                 window=None, orientation=None):
+    """Write an 'npz', 'parquet' or 'envi' export to a new file; returns (path, filename)."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    _prune_exports()
+    filename = {'npz': 'spectral_export.npz', 'parquet': 'spectral_export.parquet',
+                'envi': 'subcube_envi.zip'}[export_format]
+    path = os.path.join(EXPORT_DIR, f"{uuid.uuid4().hex}-{filename}")
+    try:
+        if export_format == 'npz':
+            export_npz(path, handle, clicked_points, roi_regions, wavelength_data)
+        elif export_format == 'parquet':
+            export_parquet(path, handle, clicked_points, roi_regions, wavelength_data)
+        else:
+            export_envi(path, handle, export_bounds(handle, roi_regions, window, orientation),
+                        wavelength_data)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path, filename
+
+def serve_export(path, filename):
+    """(download data, link) for an export file: small files are sent through
+    dcc.Download, large ones get a link to /export/<token>."""
+    size = os.path.getsize(path)
+    if size <= EXPORT_INLINE_BYTES:
+        download = dcc.send_file(path, filename)
+        os.remove(path)
+        return download, ""
+    # Exports are written by the long callback's worker process, so the
+    # token is looked up on disk rather than in this process' memory
+    token = os.path.basename(path).partition('-')[0]
+    return dash.no_update, html.A(f"Download {filename} ({size / 1024 ** 2:.0f} MB)",
+                                  href=app.get_relative_path(f"/export/{token}"))
+
+@app.server.route('/export/<token>')
+def export_endpoint(token):
+    # Tokens are uuid4 hex strings; anything else cannot name an export
+    if len(token) != 32 or os.path.basename(token) != token:
+        flask.abort(404)
+    try:
+        with os.scandir(EXPORT_DIR) as files:
+            entry = next((file for file in files
+                          if file.is_file() and file.name.startswith(f"{token}-")), None)
+    except OSError:
+        entry = None
+    if entry is None:
+        flask.abort(404)
+    return flask.send_file(os.path.abspath(entry.path), as_attachment=True,
+                           download_name=entry.name.partition('-')[2])
+
 # Layout
 app.layout = html.Div(id='container', children=[
     # Header
@@ -322,6 +2495,13 @@ app.layout = html.Div(id='container', children=[
                         html.Div(id='selected-path', style={'display': 'inline-block'}),
                         dcc.Loading(id='loading-path', type='circle')
                     ], style={'display': 'flex', 'alignItems': 'center'}),
+                    dcc.Dropdown(
+                        id='file-select',
+                        placeholder='Files in folder',
+                        optionHeight=45,
+                        style={'marginTop': '10px'}
+                    ),
+                    dcc.Interval(id='index-poll', interval=1000, disabled=True),
                 ], style={'marginBottom': '20px'}),
 
                 # File Format Selection
@@ -342,6 +2522,17 @@ app.layout = html.Div(id='container', children=[
                             style={'margin': '10px 0'},
                             className='radio-items'
                         ),
+                        dcc.Checklist(
+                            id='load-options',
+                            options=[
+                                {'label': ' Lazy loading (memory-map NPY/ENVI, windowed TIFF/MAT v7.3) ', 'value': 'lazy'},
+                                {'label': ' Build TIFF overviews if missing ', 'value': 'overviews'},
+                                {'label': ' Compress cube cache (HDF5/gzip) ', 'value': 'compress'}
+                            ],
+                            value=[],
+                            style={'margin': '10px 0'},
+                            className='radio-items'
+                        ),
                         html.Span("ⓘ", id='format-tooltip', style=STYLE['tooltip']),
                         dcc.Tooltip(
                             id='format-tooltip-content',
@@ -376,8 +2567,89 @@ app.layout = html.Div(id='container', children=[
                         placeholder='End wavelength (nm)',
                         style={**STYLE['input'], 'width': '150px'}
                     ),
-                    html.Div(id='wavelength-error', style={'color': 'red', 'marginTop': '5px'})
+                    html.Div(id='wavelength-error', style={'color': 'red', 'marginTop': '5px'}),
+                    # Only these bands are read from disk
+                    html.Label("Load Bands:", style={**STYLE['label'], 'marginTop': '10px'}),
+                    html.Div([
+                        dcc.Input(id='band-start', type='number', placeholder='From',
+                                  style={**STYLE['input'], 'width': '80px'}),
+                        dcc.Input(id='band-end', type='number', placeholder='To',
+                                  style={**STYLE['input'], 'width': '80px'}),
+                        dcc.Input(id='band-binning', type='number', min=1, step=1,
+                                  placeholder='Bin size',
+                                  style={**STYLE['input'], 'width': '80px'}),
+                    ], style={'display': 'flex', 'flexWrap': 'wrap', 'gap': '5px'}),
+                    dcc.RadioItems(
+                        id='band-units',
+                        options=[
+                            {'label': ' Channel ', 'value': 'channel'},
+                            {'label': ' Wavelength (nm) ', 'value': 'wavelength'}
+                        ],
+                        value='channel',
+                        inline=True,
+                        className='radio-items'
+                    ),
                 ], id='wavelength-inputs'),
+
+                # RAW Layout Section (only used when there is no JSON sidecar)
+                html.Div([
+                    html.Label("RAW Layout:", style=STYLE['label']),
+                    html.Div([
+                        dcc.Input(id='raw-width', type='number', min=1, placeholder='Width',
+                                  style={**STYLE['input'], 'width': '80px'}),
+                        dcc.Input(id='raw-height', type='number', min=1, placeholder='Height',
+                                  style={**STYLE['input'], 'width': '80px'}),
+                        dcc.Input(id='raw-bands', type='number', min=1, placeholder='Bands',
+                                  style={**STYLE['input'], 'width': '80px'}),
+                        dcc.Input(id='raw-offset', type='number', min=0, placeholder='Header bytes',
+                                  style={**STYLE['input'], 'width': '110px'}),
+                    ], style={'display': 'flex', 'flexWrap': 'wrap', 'gap': '5px'}),
+                    dcc.Dropdown(
+                        id='raw-dtype',
+                        options=[{'label': dtype, 'value': dtype} for dtype in
+                                 ('uint8', 'uint16', 'int16', 'uint32', 'int32',
+                                  'float32', 'float64')],
+                        value='uint16',
+                        clearable=False,
+                        style={'margin': '10px 0', 'width': '150px'}
+                    ),
+                    dcc.RadioItems(
+                        id='raw-byte-order',
+                        options=[
+                            {'label': ' Little-endian ', 'value': 'little'},
+                            {'label': ' Big-endian ', 'value': 'big'}
+                        ],
+                        value='little',
+                        className='radio-items'
+                    ),
+                    dcc.RadioItems(
+                        id='raw-interleave',
+                        options=[
+                            {'label': ' BSQ ', 'value': 'bsq'},
+                            {'label': ' BIL ', 'value': 'bil'},
+                            {'label': ' BIP ', 'value': 'bip'}
+                        ],
+                        value='bsq',
+                        className='radio-items'
+                    ),
+                    html.Div("RAW cubes are read as [H, W, C]; the dimension order is ignored.",
+                             style={'fontSize': '0.85em', 'marginTop': '5px'})
+                ], id='raw-layout-inputs', style={'display': 'none', 'marginTop': '20px'}),
+
+                # HSD sample type (the header only gives the cube size)
+                html.Div([
+                    html.Label("HSD Sample Type:", style=STYLE['label']),
+                    dcc.Dropdown(
+                        id='hsd-dtype',
+                        options=[{'label': 'Auto (8/16-bit unsigned)', 'value': 'auto'}] +
+                                [{'label': dtype, 'value': dtype} for dtype in
+                                 ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32',
+                                  'float32', 'float64')],
+                        value='auto',
+                        clearable=False,
+                        style={'margin': '10px 0', 'width': '200px'}
+                    ),
+                ], id='hsd-layout-inputs', style={'display': 'none', 'marginTop': '20px'}),
             ], style={
                 'width': '30%',
                 'padding': '20px',
@@ -402,7 +2674,7 @@ app.layout = html.Div(id='container', children=[
                                 {'label': ' [H, W, C] ', 'value': 'hwc'},
                                 {'label': ' [W, H, C] ', 'value': 'whc'}
                             ],
-                            value='chw',
+                            value=DEFAULT_DIM_ORDER,
                             style={
                                 'margin': '10px 0',
                             }),
@@ -501,6 +2773,83 @@ app.layout = html.Div(id='container', children=[
                 # Left Panel - Controls
                 html.Div([
                     html.H4("Image Controls", style={'marginBottom': '15px'}),
+                    # Band transport: quantized PNG or float heatmap
+                    html.Div([
+                        html.Label("Rendering:", style=STYLE['label']),
+                        dcc.RadioItems(
+                            id='render-mode',
+                            options=[
+                                {'label': ' PNG 8-bit ', 'value': 'png8'},
+                                {'label': ' PNG 16-bit ', 'value': 'png16'},
+                                {'label': ' Heatmap (values on hover) ', 'value': 'heatmap'}
+                            ],
+                            # Heatmap keeps contrast/brightness in the browser;
+                            # the PNG modes re-render on every slider change
+                            value='heatmap',
+                            style={'marginBottom': '15px'},
+                            className='radio-items'
+                        ),
+                    ]),
+                    # Single band or false-color composite
+                    html.Div([
+                        html.Label("Display:", style=STYLE['label']),
+                        dcc.RadioItems(
+                            id='display-mode',
+                            options=[
+                                {'label': ' Single band ', 'value': 'band'},
+                                {'label': ' RGB composite ', 'value': 'rgb'},
+                                {'label': ' PCA components ', 'value': 'pca'},
+                                {'label': ' MNF components ', 'value': 'mnf'}
+                            ],
+                            value='band',
+                            className='radio-items'
+                        ),
+                        html.Div([
+                            dcc.Dropdown(
+                                id='rgb-preset',
+                                options=[
+                                    {'label': 'True color', 'value': 'true-color'},
+                                    {'label': 'Saved preset', 'value': 'user'},
+                                    {'label': 'Custom', 'value': 'custom'}
+                                ],
+                                value='true-color',
+                                clearable=False,
+                                style={'marginBottom': '5px'}
+                            ),
+                            dcc.RadioItems(
+                                id='rgb-units',
+                                options=[
+                                    {'label': ' Channel ', 'value': 'channel'},
+                                    {'label': ' Wavelength (nm) ', 'value': 'wavelength'}
+                                ],
+                                value='channel',
+                                inline=True,
+                                className='radio-items'
+                            ),
+                            html.Div([
+                                dcc.Input(id=f'rgb-{color}', type='number', placeholder=color[0].upper(),
+                                          debounce=True,
+                                          style={**STYLE['input'], 'width': '33%', 'padding': '4px'})
+                                for color in ('red', 'green', 'blue')
+                            ], style={'display': 'flex', 'gap': '4px', 'margin': '5px 0'}),
+                            html.Button('Save Preset', id='rgb-save',
+                                        style={**STYLE['button'], 'width': '100%'})
+                        ], id='rgb-controls', style={'display': 'none'})
+                    ], style={'marginBottom': '15px'}),
+                    # Similarity to the last clicked spectrum
+                    html.Div([
+                        html.Label("Similarity Overlay:", style=STYLE['label']),
+                        dcc.RadioItems(
+                            id='similarity-mode',
+                            options=[
+                                {'label': ' Off ', 'value': 'off'},
+                                {'label': ' Spectral angle ', 'value': 'sam'},
+                                {'label': ' Correlation ', 'value': 'corr'}
+                            ],
+                            value='off',
+                            className='radio-items'
+                        ),
+                    ], style={'marginBottom': '15px'}),
                     # Image Enhancement Controls
                     html.Div([
                         html.Label("Enhancement:", style=STYLE['label']),
@@ -563,7 +2912,8 @@ app.layout = html.Div(id='container', children=[
                                 type='circle',
                                 children=[
                                     dcc.Graph(id='hsi-image',
-                                             config={'displayModeBar': True, 'scrollZoom': True},
+                                             config={'displayModeBar': True, 'scrollZoom': True,
+                                                     'modeBarButtonsToAdd': ['select2d', 'lasso2d']},
                                              style={'height': '45vh'})  # Reduced height
                                 ]
                             )
@@ -593,7 +2943,21 @@ app.layout = html.Div(id='container', children=[
                     html.Button('Clear', id='clear-button',
                                style={'backgroundColor': '#e67e22', 'color': 'white', **STYLE['button']}),
                     html.Button('Export Data', id='export-button',
-                               style={'backgroundColor': '#3498db', 'color': 'white', **STYLE['button']})
+                               style={'backgroundColor': '#3498db', 'color': 'white', **STYLE['button']}),
+                    dcc.Dropdown(
+                        id='export-format',
+                        options=[
+                            {'label': 'Spectra (CSV)', 'value': 'csv'},
+                            {'label': 'Spectra + ROI pixels (NPZ)', 'value': 'npz'},
+                            {'label': 'Spectra + ROI pixels (Parquet)', 'value': 'parquet'},
+                            {'label': 'Sub-cube: last ROI or view (ENVI)', 'value': 'envi'}
+                        ],
+                        value='csv',
+                        clearable=False,
+                        style={'width': '260px', 'display': 'inline-block',
+                               'verticalAlign': 'middle', 'textAlign': 'left'}
+                    ),
+                    html.Div(id='export-status', style={'marginTop': '5px'})
                 ], style={'textAlign': 'center'})
             ], style={'height': '28vh'})  # Adjusted height
         ], id='analysis-section', style={
@@ -606,9 +2970,19 @@ app.layout = html.Div(id='container', children=[
     # Store components
     dcc.Store(id='hsi-data'),
     dcc.Store(id='current-channel', data=0),
+    dcc.Store(id='view-window'),
+    dcc.Store(id='orientation', data=IDENTITY_ORIENTATION),
+    dcc.Store(id='enhancement'),
+    dcc.Store(id='rgb-bands'),
+    dcc.Store(id='rgb-user-preset', storage_type='local'),
     dcc.Store(id='clicked-points', data=[]),
+    dcc.Store(id='roi-regions', data=[]),
+    dcc.Store(id='similarity-ref'),
     dcc.Store(id='wavelength-data'),
     dcc.Store(id='theme', data='light'),
+    dcc.Store(id='raw-layout'),
+    # Polls update_image while PCA/MNF components are being fitted
+    dcc.Interval(id='transform-poll', interval=1000, disabled=True),
     dcc.Download(id='download-data'),
 ], style=LIGHT_THEME)
 
@@ -621,6 +2995,7 @@ app.layout = html.Div(id='container', children=[
     Input('theme', 'data'),
     prevent_initial_call=True
 )
+@instrument
 def update_panel_styles(theme):
     is_dark = theme == 'dark'
 
@@ -677,6 +3052,7 @@ def update_panel_styles(theme):
     Input('theme', 'data'),
     prevent_initial_call=True
 )
+@instrument
 def update_panel_backgrounds(theme):
     is_dark = theme == 'dark'
     panel_style = {
@@ -695,6 +3071,7 @@ def update_panel_backgrounds(theme):
     Input('theme', 'data'),
     prevent_initial_call=True
 )
+@instrument
 def update_loading_styles(theme):
     loading_style = {
         'color': '#ffffff' if theme == 'dark' else '#000000'
@@ -708,6 +3085,7 @@ def update_loading_styles(theme):
     Input('theme', 'data'),
     prevent_initial_call=True
 )
+@instrument
 def update_slider_styles(theme):
     slider_container_style = {
         'backgroundColor': '#333' if theme == 'dark' else '#ffffff',
@@ -721,10 +3099,16 @@ def update_slider_styles(theme):
     [Output('start-wavelength', 'style'),
      Output('end-wavelength', 'style'),
      Output('dim-order', 'style'),
-     Output('file-format', 'style')],
+     Output('file-format', 'style'),
+     Output('load-options', 'style'),
+     Output('render-mode', 'style'),
+     Output('display-mode', 'style'),
+     Output('rgb-units', 'style'),
+     Output('similarity-mode', 'style')],
     Input('theme', 'data'),
     prevent_initial_call=True
 )
+@instrument
 def update_input_styles(theme):
     input_style = {
         **STYLE['input'],
@@ -738,7 +3122,8 @@ def update_input_styles(theme):
         'color': '#ffffff' if theme == 'dark' else '#000000'
     }
 
-    return input_style, input_style, radio_style, radio_style
+    return (input_style, input_style, radio_style, radio_style, radio_style, radio_style,
+            radio_style, radio_style, radio_style)
 def create_dark_theme_layout():
     return {
         'plot_bgcolor': '#2d2d2d',
@@ -758,6 +3143,7 @@ def create_dark_theme_layout():
     [State('theme', 'data')],
     prevent_initial_call=True
 )
+@instrument
 def update_theme(light_clicks, dark_clicks, current_theme):
     trigger_id = ctx.triggered_id
 
@@ -774,6 +3160,7 @@ def update_theme(light_clicks, dark_clicks, current_theme):
     Input('folder-select', 'n_clicks'),
     prevent_initial_call=True
 )
+@instrument
 def select_folder(n_clicks):
     try:
         root = tk.Tk()
@@ -787,50 +3174,118 @@ def select_folder(n_clicks):
     except Exception as e:
         return f"Error: {str(e)}", ""
 
+# Callback for the folder index / file list
+@callback(
+    [Output('file-select', 'options'),
+     Output('file-select', 'value'),
+     Output('index-poll', 'disabled')],
+    [Input('selected-path', 'children'),
+     Input('file-format', 'value'),
+     Input('dim-order', 'value'),
+     Input('index-poll', 'n_intervals'),
+     Input('raw-layout', 'data')],
+    State('file-select', 'value'),
+    prevent_initial_call=True
+)
+@instrument
+def update_file_list(path, format, dim_order, n_intervals, raw_layout, selected):
+    if not path or not os.path.isdir(path):
+        return [], None, True
+
+    # Only RAW and HSD metadata depends on the layout inputs
+    layout = raw_layout if format in ('raw', 'hsd') else None
+    if ctx.triggered_id != 'index-poll':
+        start_folder_index(path, format, dim_order, layout)
+    files, done = get_folder_index(path, format, dim_order, layout)
+
+    options = []
+    for meta in files:
+        details = (f"{tuple(meta['shape'])} {meta['dtype'] or ''} {meta['interleave'] or ''}"
+                   if meta['shape'] else meta['error'] or '')
+        if meta['wavelengths']:
+            details += f" {meta['wavelengths'][0]:g}–{meta['wavelengths'][-1]:g} nm"
+        label = html.Div([
+            html.Img(src=meta['thumbnail'], style={'height': '36px', 'marginRight': '8px'})
+            if meta['thumbnail'] else None,
+            html.Span(f"{meta['name']}  {details}")
+        ], style={'display': 'flex', 'alignItems': 'center'})
+        options.append({'label': label, 'value': meta['name'], 'search': meta['name']})
+
+    names = [meta['name'] for meta in files]
+    if selected not in names:
+        selected = names[0] if names else None
+    return options, selected, done
+
+# Callback for the RAW and HSD layout inputs
+@callback(
+    [Output('raw-layout-inputs', 'style'),
+     Output('hsd-layout-inputs', 'style')],
+    Input('file-format', 'value')
+)
+@instrument
+def toggle_raw_layout(format):
+    return tuple({'display': 'block' if format == shown else 'none', 'marginTop': '20px'}
+                 for shown in ('raw', 'hsd'))
+
+@callback(
+    Output('raw-layout', 'data'),
+    [Input('raw-width', 'value'),
+     Input('raw-height', 'value'),
+     Input('raw-bands', 'value'),
+     Input('raw-dtype', 'value'),
+     Input('raw-byte-order', 'value'),
+     Input('raw-interleave', 'value'),
+     Input('raw-offset', 'value'),
+     Input('file-format', 'value'),
+     Input('hsd-dtype', 'value')]
+)
+@instrument
+def update_raw_layout(width, height, bands, dtype, byte_order, interleave, offset,
+                      format='raw', hsd_dtype='auto'):
+    # HSD captures carry their own size, so only the sample type is passed
+    if format == 'hsd':
+        return {'dtype': hsd_dtype} if hsd_dtype != 'auto' else None
+    return {'width': width, 'height': height, 'bands': bands, 'dtype': dtype,
+            'byte_order': byte_order, 'interleave': interleave, 'offset': offset or 0}
+
 # Callback for preview image
 @callback(
     Output('preview-image', 'figure'),
     [Input('selected-path', 'children'),
      Input('dim-order', 'value'),
      Input('file-format', 'value'),
-     Input('theme', 'data')],
+     Input('theme', 'data'),
+     Input('raw-layout', 'data'),
+     Input('file-select', 'value')],
     prevent_initial_call=True
 )
-def update_preview(path, dim_order, format, theme):
+@instrument
+def update_preview(path, dim_order, format, theme, raw_layout=None, selected_file=None):
     if path == "No folder selected":
         return go.Figure()
 
     try:
-        # Find the first file with the specified format
-        if os.path.isdir(path):
-            files = [f for f in os.listdir(path) if f.endswith(f'.{format}')]
-            if not files:
-                raise Exception(f"No .{format} files found")
-            file_path = os.path.join(path, files[0])
-        else:
-            file_path = path
-
-        data = load_data(file_path, format)
-
-        # Transform data based on dimension order
-        if dim_order == 'chw':
-            preview = data[0, :, :]
-        elif dim_order == 'cwh':
-            preview = data[0, :, :].T
-        elif dim_order == 'hwc':
-            preview = data[:, :, 0]
-        else:  # whc
-            preview = data[:, :, 0].T
-
-        preview = normalize_image(preview)
-
-        fig = go.Figure(data=go.Heatmap(
-            z=preview,
-            colorscale='Gray',
-            showscale=True
+        # Use the file picked in the file list, else the first match
+        file_path = find_data_file(path, format, selected_file)
+
+        # Only the first band is read; cached per (file, dim_order) so
+        # switching the order back or changing theme does not touch the disk
+        layout_key = (json.dumps(raw_layout, sort_keys=True)
+                      if format in ('raw', 'hsd') and raw_layout else None)
+        preview, factor = _preview_band(os.path.abspath(file_path),
+                                        os.path.getmtime(file_path), format, dim_order,
+                                        layout_key)
+
+        fig = go.Figure(data=go.Image(
+            source=encode_png(preview),
+            x0=(factor - 1) / 2,
+            dx=factor,
+            y0=(factor - 1) / 2,
+            dy=factor
         ))
         fig.update_layout(
             title='Preview (First Channel)',
+            yaxis=dict(autorange=True),
             margin=dict(l=0, r=0, t=30, b=0),
             plot_bgcolor='rgba(0,0,0,0)',
             paper_bgcolor='rgba(0,0,0,0)'
@@ -866,12 +3321,22 @@ def update_preview(path, dim_order, format, theme):
         State('file-format', 'value'),
         State('dim-order', 'value'),
         State('start-wavelength', 'value'),
-        State('end-wavelength', 'value')
+        State('end-wavelength', 'value'),
+        State('load-options', 'value'),
+        State('raw-layout', 'data'),
+        State('file-select', 'value'),
+        State('band-start', 'value'),
+        State('band-end', 'value'),
+        State('band-units', 'value'),
+        State('band-binning', 'value')
     ],
     manager=long_callback_manager,
     prevent_initial_call=True
 )
-def load_hsi_data(n_clicks, path, format, dim_order, start_wl, end_wl):
+@instrument
+def load_hsi_data(n_clicks, path, format, dim_order, start_wl, end_wl, load_options=None,
+                  raw_layout=None, selected_file=None, band_start=None, band_end=None,
+                  band_units='channel', binning=None):
     if path == "No folder selected":
         return [dash.no_update] * 6
 
@@ -882,16 +3347,17 @@ def load_hsi_data(n_clicks, path, format, dim_order, start_wl, end_wl):
             raise ValueError(message)
 
         # Find and load the file
-        if os.path.isdir(path):
-            files = [f for f in os.listdir(path) if f.endswith(f'.{format}')]
-            if not files:
-                raise Exception(f"No .{format} files found in directory")
-            file_path = os.path.join(path, files[0])
-        else:
-            file_path = path
-
-        data = load_data(file_path, format)
-        original_shape = data.shape
+        file_path = find_data_file(path, format, selected_file)
+        dim_order = format_dim_order(format, dim_order)
+
+        lazy = 'lazy' in (load_options or [])
+        if format == 'tif' and 'overviews' in (load_options or []):
+            build_tiff_overviews(file_path)
+        layout = None
+        if format == 'raw':
+            layout = read_raw_layout(file_path) or raw_layout
+        elif format == 'hsd':
+            layout = raw_layout
 
         # Check for wavelength information in metadata
         wavelength_data = None
@@ -908,173 +3374,453 @@ def load_hsi_data(n_clicks, path, format, dim_order, start_wl, end_wl):
         if wavelength_data is None and start_wl is not None and end_wl is not None:
             wavelength_data = {'start': start_wl, 'end': end_wl}
 
-        # Standardize to [H, W, C] format
-        if dim_order == 'chw':
-            data = np.transpose(data, (1, 2, 0))
-        elif dim_order == 'cwh':
-            data = np.transpose(data, (2, 1, 0))
-        elif dim_order == 'whc':
-            data = np.transpose(data, (1, 0, 2))
+        # Band subset and binning, applied while reading
+        bands = None
+        binning = int(binning or 1)
+        if band_start is not None or band_end is not None or binning > 1:
+            num_channels = source_band_count(file_path, format, dim_order, layout)
+            start, stop = resolve_band_range(band_start, band_end, band_units,
+                                             wavelength_data, num_channels)
+            bands = {'start': start, 'stop': stop, 'binning': binning}
+            if wavelength_data:
+                wavelength_data = subset_wavelengths(wavelength_data, num_channels, **bands)
+
+        handle = cube_cache_key(file_path, format, dim_order, layout, bands, load_options)
+        meta = get_cube_meta(handle)
+        if meta is not None:
+            # Loaded before: reuse the cached cube and statistics as they are
+            data = get_cube(handle)
+            original_shape = tuple(meta['original_shape'])
+        else:
+            # Subsets are sliced out of a lazy view, so only their bands are read
+            data = load_data(file_path, format, lazy=lazy or bands is not None, layout=layout)
+            original_shape = data.shape
+
+            # Standardize to [H, W, C] format
+            data = standardize_cube(data, dim_order)
+            if bands:
+                data = subset_bands(data, **bands)
+                if not lazy and format not in ('raw', 'hsd'):
+                    data = np.array(data)
+            if isinstance(data, RasterioCube) and data.has_band_overviews():
+                # Large mosaics: estimate the table from an overview level
+                factor = 1
+                while max(data.shape[:2]) > factor * STATS_OVERVIEW_SIZE:
+                    factor *= 2
+                stats = compute_band_stats(data.decimated(factor) if factor > 1 else data)
+            elif isinstance(data, (np.memmap, _LazyCube)):
+                # Other on-disk cubes: estimate the table from a strided
+                # sample, so the first image does not wait for a full pass
+                stats = compute_band_stats(strided_sample(data))
+            else:
+                stats = compute_band_stats(data)
+            if isinstance(data, (np.memmap, _LazyCube)):
+                source = {'path': os.path.abspath(file_path), 'format': format,
+                          'dim_order': dim_order, 'layout': layout, 'bands': bands}
+                register_cube(data, source=source, stats=stats, handle=handle,
+                              original_shape=original_shape)
+            else:
+                register_cube(data, stats=stats, handle=handle, original_shape=original_shape,
+                              compression='gzip' if 'compress' in (load_options or []) else None)
+            evict_cube_cache(keep=(handle,))
 
         dim_info = (f"Original dimensions: {original_shape} ({dim_order}) → "
                    f"Standardized [H, W, C]: {data.shape}")
+        if bands:
+            dim_info += f" · bands {bands['start'] + 1}–{bands['stop']}"
+            if binning > 1:
+                dim_info += f" binned by {binning}"
 
-        return (data.tolist(), dim_info,
+        return ({'handle': handle, 'shape': list(data.shape)}, dim_info,
                 {'display': 'none'}, {'display': 'block'}, "",
                 wavelength_data)
 
     except Exception as e:
         return [dash.no_update] * 5 + [f"Error: {str(e)}"]
 
-# Image enhancement callback
+# Image enhancement callback (runs in the browser: contrast and brightness
+# only move the heatmap's color range, see enhancement_range). PNG images
+# cannot be remapped in place, so for those the values are handed to
+# update_image_enhancement through the enhancement store.
+clientside_callback(
+    """
+    function(contrast, brightness, figure) {
+        const no_update = window.dash_clientside.no_update;
+        if (!figure || !figure.data || !figure.data.length) {
+            return [no_update, no_update];
+        }
+        const c = contrast || 1.0;
+        const b = brightness || 0.0;
+        if (figure.data.some(trace => trace.type === 'image')) {
+            return [no_update, {contrast: c, brightness: b}];
+        }
+        return [Object.assign({}, figure, {
+            data: figure.data.map(trace => {
+                if (trace.type !== 'heatmap') {
+                    return trace;
+                }
+                // Band heatmaps carry 8-bit levels; see create_band_figure
+                const s = (trace.meta && trace.meta.zscale) || 1;
+                return Object.assign({}, trace,
+                                     {zmin: -b / c * s, zmax: (1 - b) / c * s, zauto: false});
+            })
+        }), no_update];
+    }
+    """,
+    [Output('hsi-image', 'figure', allow_duplicate=True),
+     Output('enhancement', 'data')],
+    [Input('contrast-slider', 'value'),
+     Input('brightness-slider', 'value')],
+    State('hsi-image', 'figure'),
+    prevent_initial_call=True
+)
+
+# Image enhancement callback for PNG rendering
 @callback(
     Output('hsi-image', 'figure', allow_duplicate=True),
-    [Input('contrast-slider', 'value'),
-     Input('brightness-slider', 'value'),
-     Input('theme', 'data')],
+    Input('enhancement', 'data'),
     [State('hsi-data', 'data'),
-     State('current-channel', 'data')],
+     State('current-channel', 'data'),
+     State('view-window', 'data'),
+     State('render-mode', 'value'),
+     State('theme', 'data'),
+     State('orientation', 'data'),
+     State('rgb-bands', 'data'),
+     State('similarity-ref', 'data'),
+     State('display-mode', 'value')],
     prevent_initial_call=True
 )
-def update_image_enhancement(contrast, brightness, theme, data, current_channel):
-    if not data:
+@instrument
+def update_image_enhancement(enhancement, data, current_channel, window, render_mode, theme,
+                             orientation=None, rgb_bands=None, similarity=None,
+                             display_mode='band'):
+    if not data or not enhancement:
+        return dash.no_update
+    # update_image renders the components once they are fitted
+    if (display_mode in SPECTRAL_TRANSFORMS
+            and not spectral_transform_ready(data['handle'], display_mode)):
         return dash.no_update
 
-    data = np.array(data)
-    channel_data = data[:, :, current_channel]
-    channel_data = normalize_image(channel_data)
-    enhanced_data = enhance_image(channel_data, contrast, brightness)
-
-    fig = go.Figure(data=go.Heatmap(
-        z=enhanced_data,
-        colorscale='Gray',
-        showscale=True,
-        hoverongaps=False
-    ))
-
-    fig.update_layout(
-        margin=dict(l=0, r=0, t=0, b=0),
-        xaxis=dict(showticklabels=False, scaleanchor="y", scaleratio=1),
-        yaxis=dict(showticklabels=False),
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)'
-    )
-
-    fig = apply_theme_to_figure(fig, theme)
-    return fig
+    channel = tuple(rgb_bands) if rgb_bands else current_channel
+    return render_band(_display_handle(data, display_mode), channel, window, orientation, theme,
+                       contrast=enhancement['contrast'],
+                       brightness=enhancement['brightness'],
+                       render_mode=render_mode,
+                       similarity=_usable_similarity(similarity, data))
 
 # Image orientation callback
 @callback(
-    [Output('hsi-data', 'data', allow_duplicate=True),
-     Output('current-channel', 'data', allow_duplicate=True)],
+    Output('orientation', 'data'),
     [Input('vertical-flip', 'n_clicks'),
      Input('horizontal-flip', 'n_clicks'),
-     Input('rotate-90', 'n_clicks')],
-    [State('hsi-data', 'data'),
-     State('current-channel', 'data')],
+     Input('rotate-90', 'n_clicks'),
+     Input('hsi-data', 'data')],
+    State('orientation', 'data'),
     prevent_initial_call=True
 )
-def apply_orientation(v_flip, h_flip, rotate, data, current_channel):
+@instrument
+def apply_orientation(v_flip, h_flip, rotate, data, orientation):
     if not data:
-        return dash.no_update, dash.no_update
+        return dash.no_update
 
-    data = np.array(data)
     trigger_id = ctx.triggered_id
+    if trigger_id == 'hsi-data':
+        # A newly loaded cube starts unrotated
+        return IDENTITY_ORIENTATION
+    return compose_orientation(orientation, trigger_id)
+
+# Visible region callback
+@callback(
+    Output('view-window', 'data'),
+    [Input('hsi-image', 'relayoutData'),
+     Input('hsi-data', 'data'),
+     Input('orientation', 'data')],
+    prevent_initial_call=True
+)
+@instrument
+def update_view_window(relayout_data, data, orientation):
+    if ctx.triggered_id in ('hsi-data', 'orientation'):
+        return None
+    return parse_view_window(relayout_data)
+
+# RGB composite controls
+@callback(
+    Output('rgb-controls', 'style'),
+    Input('display-mode', 'value')
+)
+@instrument
+def toggle_rgb_controls(display_mode):
+    return {'display': 'block' if display_mode == 'rgb' else 'none', 'marginTop': '5px'}
 
-    if trigger_id == 'vertical-flip':
-        data = np.flip(data, axis=0)
-    elif trigger_id == 'horizontal-flip':
-        data = np.flip(data, axis=1)
-    elif trigger_id == 'rotate-90':
-        data = np.rot90(data)
+@callback(
+    [Output('rgb-red', 'value'),
+     Output('rgb-green', 'value'),
+     Output('rgb-blue', 'value'),
+     Output('rgb-units', 'value')],
+    [Input('rgb-preset', 'value'),
+     Input('hsi-data', 'data')],
+    [State('rgb-user-preset', 'data'),
+     State('wavelength-data', 'data')]
+)
+@instrument
+def apply_rgb_preset(preset, data, user_preset, wavelength_data):
+    if preset == 'user' and user_preset:
+        return (*user_preset['bands'], user_preset['units'])
+    if preset != 'true-color' or not data:
+        return [dash.no_update] * 4
+    if wavelength_data:
+        return (*TRUE_COLOR_WAVELENGTHS, 'wavelength')
+    # No wavelength range: spread the bands over the cube instead
+    num_channels = data['shape'][2]
+    return (num_channels * 3 // 4 + 1, num_channels // 2 + 1, num_channels // 4 + 1, 'channel')
 
-    return data.tolist(), current_channel
+@callback(
+    Output('rgb-user-preset', 'data'),
+    Input('rgb-save', 'n_clicks'),
+    [State('rgb-red', 'value'),
+     State('rgb-green', 'value'),
+     State('rgb-blue', 'value'),
+     State('rgb-units', 'value')],
+    prevent_initial_call=True
+)
+@instrument
+def save_rgb_preset(n_clicks, red, green, blue, units):
+    if None in (red, green, blue):
+        return dash.no_update
+    return {'bands': [red, green, blue], 'units': units}
 
-def cleanup_data():
-    import gc
-    gc.collect()
+@callback(
+    Output('rgb-bands', 'data'),
+    [Input('display-mode', 'value'),
+     Input('rgb-red', 'value'),
+     Input('rgb-green', 'value'),
+     Input('rgb-blue', 'value'),
+     Input('rgb-units', 'value'),
+     Input('hsi-data', 'data')],
+    State('wavelength-data', 'data')
+)
+@instrument
+def update_rgb_bands(display_mode, red, green, blue, units, data, wavelength_data):
+    if display_mode != 'rgb' or not data:
+        return None
+    bands = resolve_rgb_bands((red, green, blue), units, wavelength_data, data['shape'][2])
+    return list(bands) if bands else dash.no_update
+
+# Similarity overlay reference
+@callback(
+    Output('similarity-ref', 'data'),
+    [Input('similarity-mode', 'value'),
+     Input('clicked-points', 'data')],
+    State('similarity-ref', 'data')
+)
+@instrument
+def update_similarity_reference(mode, clicked_points, current):
+    if mode == 'off' or not clicked_points:
+        reference = None
+    else:
+        reference = {'metric': mode, 'point': len(clicked_points),
+                     'spectrum': clicked_points[-1]['spectrum']}
+    # Only changes should re-render the image
+    return dash.no_update if reference == current else reference
+
+def _usable_similarity(similarity, data):
+    """The similarity reference, unless it was clicked on a cube with another band count."""
+    if similarity and len(similarity['spectrum']) == data['shape'][2]:
+        return similarity
+    return None
+
+def _display_handle(data, display_mode):
+    """Handle whose bands hsi-image shows: the cube, or its PCA/MNF components."""
+    if display_mode in SPECTRAL_TRANSFORMS:
+        return component_handle(data['handle'], display_mode)
+    return data['handle']
+
+def transform_pending_figure(method, theme):
+    """Placeholder for hsi-image while a cube's components are being fitted."""
+    fig = go.Figure()
+    fig.add_annotation(
+        text=f"Computing {method.upper()} components…",
+        xref="paper", yref="paper",
+        x=0.5, y=0.5,
+        showarrow=False
+    )
+    fig.update_layout(xaxis=dict(visible=False), yaxis=dict(visible=False))
+    return apply_theme_to_figure(fig, theme)
 
 # Channel navigation and display callback
 @callback(
     [Output('hsi-image', 'figure'),
      Output('channel-info', 'children'),
-     Output('current-channel', 'data')],
+     Output('current-channel', 'data'),
+     Output('transform-poll', 'disabled')],
     [Input('hsi-data', 'data'),
      Input('current-channel', 'data'),
      Input('prev-channel', 'n_clicks'),
      Input('next-channel', 'n_clicks'),
-     Input('theme', 'data')],
+     Input('theme', 'data'),
+     Input('view-window', 'data'),
+     Input('render-mode', 'value'),
+     Input('orientation', 'data'),
+     Input('rgb-bands', 'data'),
+     Input('similarity-ref', 'data'),
+     Input('display-mode', 'value'),
+     Input('transform-poll', 'n_intervals')],
+    [State('contrast-slider', 'value'),
+     State('brightness-slider', 'value')],
     prevent_initial_call=True
 )
-def update_image(data, current_channel, prev_clicks, next_clicks, theme):
+@instrument
+def update_image(data, current_channel, prev_clicks, next_clicks, theme, window=None,
+                 render_mode='heatmap', orientation=None, rgb_bands=None, similarity=None,
+                 display_mode='band', poll_intervals=None, contrast=1.0, brightness=0.0):
     if not data:
-        return dash.no_update, dash.no_update, dash.no_update
-
-    data = np.array(data)
-    num_channels = data.shape[2]
+        return dash.no_update, dash.no_update, dash.no_update, True
+
+    handle = _display_handle(data, display_mode)
+    num_channels = data['shape'][2]
+    band_label = "Channel"
+    if display_mode in SPECTRAL_TRANSFORMS:
+        # The first call starts the fit (one pass over the cube) in the
+        # background; transform-poll re-runs this callback until it is done
+        try:
+            ready = spectral_transform_ready(data['handle'], display_mode)
+        except Exception as e:
+            return (dash.no_update, f"{display_mode.upper()} failed: {str(e)}",
+                    current_channel, True)
+        if not ready:
+            return (transform_pending_figure(display_mode, theme),
+                    f"Computing {display_mode.upper()} components…", current_channel, False)
+        num_channels = get_cube(handle).shape[2]
+        band_label = f"{display_mode.upper()} component"
+    # A newly loaded cube or subset may have fewer bands than the last one
+    current_channel = min(current_channel or 0, num_channels - 1)
     trigger_id = ctx.triggered_id
-
-    if trigger_id == 'prev-channel' and current_channel > 0:
-        current_channel -= 1
+    similarity = _usable_similarity(similarity, data)
+    similarity_info = ""
+    if similarity:
+        label = 'spectral angle' if similarity['metric'] == 'sam' else 'correlation'
+        similarity_info = f" · {label} to point {similarity['point']}"
+
+    if rgb_bands:
+        fig = render_band(handle, tuple(rgb_bands), window, orientation, theme,
+                          contrast=contrast, brightness=brightness, render_mode=render_mode,
+                          similarity=similarity)
+        info = "RGB: channels " + ", ".join(str(channel + 1) for channel in rgb_bands)
+        return fig, info + similarity_info, current_channel, True
+
+    step = 1
+    if trigger_id == 'prev-channel':
+        step = -1
+        if current_channel > 0:
+            current_channel -= 1
     elif trigger_id == 'next-channel' and current_channel < num_channels - 1:
         current_channel += 1
 
-    channel_data = data[:, :, current_channel]
-    channel_data = normalize_image(channel_data)
-
-    fig = go.Figure(data=go.Heatmap(
-        z=channel_data,
-        colorscale='Gray',
-        showscale=True,
-        hoverongaps=False
-    ))
-
-    fig.update_layout(
-        margin=dict(l=0, r=0, t=0, b=0),
-        xaxis=dict(showticklabels=False, scaleanchor="y", scaleratio=1),
-        yaxis=dict(showticklabels=False),
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)'
-    )
-
-    # Call cleanup_data() after creating the figure
-    cleanup_data()
+    fig = render_band(handle, current_channel, window, orientation, theme,
+                      contrast=contrast, brightness=brightness, render_mode=render_mode,
+                      similarity=similarity)
+    prefetch_bands(handle, current_channel, step, num_channels, window, orientation, theme,
+                   contrast=contrast, brightness=brightness, render_mode=render_mode,
+                   similarity=similarity)
 
-    fig = apply_theme_to_figure(fig, theme)
-    return fig, f"Channel: {current_channel + 1} / {num_channels}", current_channel
+    return (fig, f"{band_label}: {current_channel + 1} / {num_channels}{similarity_info}",
+            current_channel, True)
 
 # Spectral plot callback
+ROI_COLORS = ((99, 110, 250), (239, 85, 59), (0, 204, 150), (171, 99, 250), (255, 161, 90))
+
+def add_roi_traces(fig, x_axis, stats, name, color):
+    """Plot an ROI as its mean with shaded mean ± std and percentile envelopes."""
+    rgb = ','.join(str(c) for c in color)
+    mean, std = np.array(stats['mean']), np.array(stats['std'])
+    envelopes = ((stats['p_lo'], stats['p_hi'], 0.15,
+                  f"P{ROI_PERCENTILES[0]}–P{ROI_PERCENTILES[1]}"),
+                 (mean - std, mean + std, 0.3, "±1 std"))
+    for lower, upper, alpha, label in envelopes:
+        fig.add_trace(go.Scatter(
+            x=np.concatenate([x_axis, x_axis[::-1]]),
+            y=np.concatenate([upper, np.asarray(lower)[::-1]]),
+            fill='toself',
+            fillcolor=f'rgba({rgb},{alpha})',
+            line=dict(width=0),
+            hoverinfo='skip',
+            name=f"{name} {label}",
+            legendgroup=name,
+            showlegend=False
+        ))
+    for values, label in ((stats['min'], 'min'), (stats['max'], 'max')):
+        fig.add_trace(go.Scatter(
+            x=x_axis, y=values, mode='lines', line=dict(color=f'rgb({rgb})', width=1, dash='dot'),
+            name=f"{name} {label}", legendgroup=name, showlegend=False
+        ))
+    fig.add_trace(go.Scatter(
+        x=x_axis, y=mean, mode='lines', line=dict(color=f'rgb({rgb})', width=2),
+        name=name, legendgroup=name
+    ))
+
 @callback(
     [Output('spectral-plot', 'figure'),
-     Output('clicked-points', 'data')],
+     Output('clicked-points', 'data'),
+     Output('roi-regions', 'data')],
     [Input('hsi-image', 'clickData'),
+     Input('hsi-image', 'selectedData'),
      Input('undo-button', 'n_clicks'),
      Input('clear-button', 'n_clicks'),
      Input('theme', 'data')],
     [State('hsi-data', 'data'),
      State('clicked-points', 'data'),
-     State('wavelength-data', 'data')],
+     State('wavelength-data', 'data'),
+     State('orientation', 'data'),
+     State('roi-regions', 'data')],
     prevent_initial_call=True
 )
 
-def update_spectral_plot(click_data, undo_clicks, clear_clicks, theme, hsi_data, clicked_points, wavelength_data):
+@instrument
+def update_spectral_plot(click_data, selected_data, undo_clicks, clear_clicks, theme, hsi_data,
+                         clicked_points, wavelength_data, orientation=None, roi_regions=None):
     if not hsi_data:
-        return dash.no_update, dash.no_update
+        return dash.no_update, dash.no_update, dash.no_update
 
     trigger_id = ctx.triggered_id
-    data = np.array(hsi_data)
+    triggered_prop = ctx.triggered[0]['prop_id'] if ctx.triggered else ''
+    data = get_cube(hsi_data['handle'])
+    roi_regions = roi_regions or []
 
     if trigger_id == 'clear-button':
         clicked_points = []
-    elif trigger_id == 'undo-button' and clicked_points:
-        clicked_points.pop()
+        roi_regions = []
+    elif trigger_id == 'undo-button':
+        # Each ROI remembers how many points existed when it was drawn, so
+        # undo removes whichever was added last
+        if roi_regions and roi_regions[-1]['after_points'] == len(clicked_points):
+            roi_regions.pop()
+        elif clicked_points:
+            clicked_points.pop()
+    elif triggered_prop == 'hsi-image.selectedData':
+        selection = selection_polygon(selected_data)
+        if selection is None:
+            return dash.no_update, dash.no_update, dash.no_update
+        kind, polygon = selection
+        roi_stats = compute_roi_stats(hsi_data['handle'], kind, polygon, orientation)
+        if roi_stats is None:
+            return dash.no_update, dash.no_update, dash.no_update
+        roi_regions.append({
+            'type': kind,
+            'polygon': polygon,
+            'orientation': orientation,
+            'after_points': len(clicked_points),
+            'stats': roi_stats
+        })
     elif trigger_id == 'hsi-image' and click_data:
         point = click_data['points'][0]
         x, y = point['x'], point['y']
-        spectral_signature = data[int(y), int(x), :]
+        # Clicks are in displayed coordinates; the cube is never reoriented
+        source_y, source_x = to_source_coords(int(y), int(x), orientation, data.shape)
+        spectral_signature = get_spectrum(hsi_data['handle'], source_y, source_x)
         clicked_points.append({
             'x': x,
             'y': y,
+            'source': [source_y, source_x],
             'spectrum': spectral_signature.tolist()
         })
 
@@ -1088,6 +3834,14 @@ def update_spectral_plot(click_data, undo_clicks, clear_clicks, theme, hsi_data,
         x_axis = list(range(len(clicked_points[0]['spectrum']))) if clicked_points else []
         x_label = 'Channel'
 
+    num_channels = hsi_data['shape'][2]
+    roi_axis = (np.linspace(wavelength_data['start'], wavelength_data['end'], num_channels)
+                if wavelength_data else np.arange(num_channels))
+    for i, region in enumerate(roi_regions):
+        add_roi_traces(fig, roi_axis, region['stats'],
+                       f"ROI {i+1} ({region['type']}, {region['stats']['count']} px)",
+                       ROI_COLORS[i % len(ROI_COLORS)])
+
     for i, point in enumerate(clicked_points):
         fig.add_trace(go.Scatter(
             y=point['spectrum'],
@@ -1106,23 +3860,62 @@ def update_spectral_plot(click_data, undo_clicks, clear_clicks, theme, hsi_data,
         paper_bgcolor='rgba(0,0,0,0)'
     )
 
+    # Fix the y-axis to the cube's value range so spectra stay comparable
+    stats = get_band_stats(hsi_data['handle'])
+    y_min, y_max = float(np.min(stats['min'])), float(np.max(stats['max']))
+    if y_max > y_min:
+        pad = 0.05 * (y_max - y_min)
+        fig.update_yaxes(range=[y_min - pad, y_max + pad])
+
     # Apply theme-specific layout
     if theme == 'dark':
         fig.update_layout(create_dark_theme_layout())
 
-    return fig, clicked_points
+    return fig, clicked_points, roi_regions
 
-# Export data callback
-@callback(
-    Output('download-data', 'data'),
-    Input('export-button', 'n_clicks'),
-    [State('clicked-points', 'data'),
-     State('wavelength-data', 'data')],
+# Export data callback; exports read whole ROIs or sub-cubes, so they run
+# as a long callback instead of blocking a request
+@app.long_callback(
+    output=[
+        Output('download-data', 'data'),
+        Output('export-status', 'children')
+    ],
+    inputs=[
+        Input('export-button', 'n_clicks')
+    ],
+    state=[
+        State('clicked-points', 'data'),
+        State('wavelength-data', 'data'),
+        State('export-format', 'value'),
+        State('hsi-data', 'data'),
+        State('roi-regions', 'data'),
+        State('view-window', 'data'),
+        State('orientation', 'data')
+    ],
+    running=[
+        (Output('export-button', 'disabled'), True, False)
+    ],
+    manager=long_callback_manager,
     prevent_initial_call=True
 )
-def export_data(n_clicks, clicked_points, wavelength_data):
+@instrument
+def export_data(n_clicks, clicked_points, wavelength_data, export_format='csv', hsi_data=None,
+                roi_regions=None, window=None, orientation=None):
+    if export_format != 'csv':
+        if not hsi_data:
+            return dash.no_update, dash.no_update
+        clicked_points, roi_regions = clicked_points or [], roi_regions or []
+        if export_format != 'envi' and not clicked_points and not roi_regions:
+            return dash.no_update, "Nothing to export: click pixels or draw an ROI first"
+        try:
+            path, filename = write_export(export_format, hsi_data['handle'], clicked_points,
+                                          roi_regions, wavelength_data, window, orientation)
+        except Exception as e:
+            return dash.no_update, f"Export failed: {str(e)}"
+        return serve_export(path, filename)
+
     if not clicked_points:
-        return dash.no_update
+        return dash.no_update, dash.no_update
 
     # Create CSV content
     import io
@@ -1151,7 +3944,7 @@ def export_data(n_clicks, clicked_points, wavelength_data):
     return dict(
         content=buffer.getvalue(),
         filename='spectral_signatures.csv'
-    )
+    ), ""
 
 def apply_theme_to_figure(fig, theme):
     if theme == 'dark':
@@ -1164,5 +3957,53 @@ def apply_theme_to_figure(fig, theme):
         )
     return fig
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hyperspectral Image Analysis Dashboard")
+    commands = parser.add_subparsers(dest='command')
+    quicklook = commands.add_parser(
+        'quicklook', help="Render PNG quicklooks for every cube below a folder, without the UI")
+    quicklook.add_argument('root', help="Folder to search recursively")
+    quicklook.add_argument('-o', '--output', default='quicklooks',
+                           help="Folder for the PNGs; mirrors the tree under root")
+    quicklook.add_argument('-f', '--format', nargs='+', choices=QUICKLOOK_FORMATS,
+                           default=list(QUICKLOOK_FORMATS), help="File formats to include")
+    quicklook.add_argument('-d', '--dim-order', choices=('chw', 'cwh', 'hwc', 'whc'),
+                           help=f"Dim order of the cubes (default: {DEFAULT_DIM_ORDER}, "
+                                "as in the dashboard; RAW and HSD are always hwc)")
+    quicklook.add_argument('--raw-layout', help="JSON file with the layout of RAW files "
+                                                "without a sidecar (see read_raw_layout)")
+    quicklook.add_argument('--hsd-dtype', help="Sample type of HSD captures; required for "
+                                               "4- and 8-byte samples")
+    quicklook.add_argument('-j', '--workers', type=int, help="Worker processes (default: CPUs)")
+    quicklook.add_argument('--memory-mb', type=int, default=QUICKLOOK_MEMORY_BYTES // 1024 ** 2,
+                           help="Memory budget per worker, in MiB")
+    quicklook.add_argument('--contrast', type=float, default=1.0)
+    quicklook.add_argument('--brightness', type=float, default=0.0)
+    quicklook.add_argument('--force', action='store_true',
+                           help="Re-render quicklooks that are newer than their cube")
+    parser.add_argument('--metrics', action='store_true',
+                        help="Record per-callback latency, payload and memory at /metrics")
+    parser.add_argument('--metrics-log', help="Also append the metrics to this rotating log "
+                                              "file (implies --metrics)")
+    args = parser.parse_args(argv)
+
+    if args.command != 'quicklook':
+        if args.metrics or args.metrics_log:
+            enable_metrics(args.metrics_log)
+        app.run_server(debug=True, port=8050)
+        return 0
+
+    layout = None
+    if args.raw_layout:
+        with open(args.raw_layout) as f:
+            layout = json.load(f)
+    failed = 0
+    for result in run_quicklooks(args.root, args.output, tuple(args.format), args.dim_order,
+                                 layout, args.workers, args.memory_mb * 1024 ** 2,
+                                 args.contrast, args.brightness, args.force, args.hsd_dtype):
+        print(json.dumps(result), flush=True)
+        failed += result['error'] is not None
+    return 1 if failed else 0
+
 if __name__ == '__main__':
-    app.run_server(debug=True, port=8050)
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import os
+import zipfile
+from contextvars import copy_context
+
+import numpy as np
+import pytest
+import spectral.io as spio
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+
+import dashboard
+
+
+@pytest.fixture(autouse=True)
+def cube_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(dashboard, 'CUBE_CACHE_DIR', str(tmp_path / 'cubes'))
+    monkeypatch.setattr(dashboard, 'PREFETCH_BANDS', 0)
+
+
+def call_callback(func, prop_id, *args):
+    """Call a Dash callback outside a request, as if prop_id had triggered it."""
+    def run():
+        context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None}]))
+        return func(*args)
+    return copy_context().run(run)
+
+
+def test_raw_ignores_dim_order(tmp_path):
+    # Non-square, so a transposed read would show up in the shape
+    cube = np.arange(30 * 40 * 12, dtype=np.uint16).reshape(30, 40, 12)
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    np.ascontiguousarray(cube.transpose(2, 0, 1)).tofile(folder / 'cube.raw')
+    layout = {'width': 40, 'height': 30, 'bands': 12, 'dtype': 'uint16',
+              'byte_order': 'little', 'interleave': 'bsq', 'offset': 0}
+
+    # Default UI values: [C, H, W] dim order, no load options
+    response = dashboard.load_hsi_data(1, str(folder), 'raw', 'chw', None, None, [],
+                                       layout, 'cube.raw')
+
+    assert response[0]['shape'] == [30, 40, 12]
+    loaded = dashboard.get_cube(response[0]['handle'])
+    np.testing.assert_array_equal(np.asarray(loaded[7, 25]), cube[7, 25])
+
+
+@pytest.mark.parametrize('interleave', ['bsq', 'bil', 'bip'])
+def test_raw_round_trip(tmp_path, interleave):
+    cube = np.random.default_rng(1).integers(0, 4096, (6, 9, 5)).astype('>u2')
+    sizes = {'height': 6, 'width': 9, 'bands': 5}
+    order = [('height', 'width', 'bands').index(axis)
+             for axis in dashboard.RAW_INTERLEAVE_SHAPES[interleave]]
+    path = tmp_path / 'cube.raw'
+    path.write_bytes(b'\0' * 16 + np.ascontiguousarray(cube.transpose(order)).tobytes())
+    layout = dict(sizes, dtype='uint16', byte_order='big', interleave=interleave, offset=16)
+
+    loaded = dashboard.load_data(str(path), 'raw', layout=layout)
+
+    np.testing.assert_array_equal(np.asarray(loaded), cube)
+    np.testing.assert_array_equal(dashboard.read_band(str(path), 'raw', 'chw', 3, layout),
+                                  cube[:, :, 3])
+
+
+def write_hsd(path, cube):
+    height, width, bands = cube.shape
+    with open(path, 'wb') as f:
+        f.write(np.array([height, width, bands], dtype='<i4').tobytes())
+        f.write(np.ascontiguousarray(cube.transpose(2, 0, 1)).tobytes())
+
+
+def test_hsd_round_trip(tmp_path):
+    cube = np.random.default_rng(2).integers(0, 1000, (7, 5, 4)).astype('<u2')
+    write_hsd(tmp_path / 'cube.hsd', cube)
+
+    loaded = dashboard.load_data(str(tmp_path / 'cube.hsd'), 'hsd')
+
+    np.testing.assert_array_equal(np.asarray(loaded), cube)
+
+
+def test_hsd_wide_samples_need_a_dtype(tmp_path):
+    cube = np.random.default_rng(3).random((7, 5, 4)).astype('<f4')
+    path = str(tmp_path / 'cube.hsd')
+    write_hsd(path, cube)
+
+    with pytest.raises(Exception, match='sample type'):
+        dashboard.load_data(path, 'hsd')
+    loaded = dashboard.load_data(path, 'hsd', layout={'dtype': 'float32'})
+    np.testing.assert_array_equal(np.asarray(loaded), cube)
+
+
+def test_eager_envi_load_registers_a_plain_array(tmp_path):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    cube = np.random.default_rng(12).random((6, 8, 4)).astype(np.float32)
+    spio.envi.save_image(str(folder / 'cube.hdr'), cube, interleave='bil')
+
+    response = dashboard.load_hsi_data(1, str(folder), 'hdr', 'hwc', None, None, [], None,
+                                       'cube.hdr')
+
+    assert type(dashboard.get_cube(response[0]['handle'])) is np.ndarray
+    spectrum = dashboard.get_spectrum(response[0]['handle'], 2, 5)
+    assert spectrum.shape == (4,)
+    np.testing.assert_array_equal(spectrum, cube[2, 5])
+
+
+def test_strided_sample_of_lazy_cube(monkeypatch):
+    cube = np.random.default_rng(5).random((50, 70, 6)).astype(np.float32)
+    handle = dashboard.register_cube(cube, compression='gzip')
+    monkeypatch.setattr(dashboard, '_cube_registry', {})
+    lazy = dashboard.get_cube(handle)
+
+    sample = dashboard.strided_sample(lazy, pixels=200)
+
+    assert isinstance(sample, dashboard.StridedCube)
+    np.testing.assert_array_equal(np.asarray(sample), cube[::5, ::5])
+    np.testing.assert_array_equal(dashboard.strided_sample(cube, pixels=200), cube[::5, ::5])
+
+
+def test_lazy_load_estimates_stats_from_a_sample(tmp_path, monkeypatch):
+    monkeypatch.setattr(dashboard, 'STATS_SAMPLE_PIXELS', 100)
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    cube = np.random.default_rng(6).random((40, 30, 5)).astype(np.float32)
+    np.save(folder / 'cube.npy', cube)
+
+    response = dashboard.load_hsi_data(1, str(folder), 'npy', 'hwc', None, None, ['lazy'],
+                                       None, 'cube.npy')
+
+    stats = dashboard.get_band_stats(response[0]['handle'])
+    expected = dashboard.compute_band_stats(cube[::4, ::4])
+    for key in ('min', 'max', 'mean', 'std'):
+        np.testing.assert_allclose(stats[key], expected[key])
+
+
+def test_compressed_cache_skips_bip_copy(monkeypatch):
+    cube = np.random.default_rng(0).random((20, 30, 8)).astype(np.float32)
+    handle = dashboard.register_cube(cube, compression='gzip')
+    # As in another process: the cube is reopened from the HDF5 cache
+    monkeypatch.setattr(dashboard, '_cube_registry', {})
+    assert isinstance(dashboard.get_cube(handle), dashboard.H5Cube)
+
+    np.testing.assert_array_equal(dashboard.get_spectrum(handle, 5, 7), cube[5, 7])
+    assert handle not in dashboard._spectrum_cache
+    assert not os.path.exists(dashboard._cube_bip_file(handle))
+
+
+def test_compress_option_gets_its_own_cache_entry(tmp_path):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    cube = np.random.default_rng(4).random((16, 12, 10)).astype(np.float32)
+    np.save(folder / 'cube.npy', cube)
+
+    handles = {}
+    for options in ([], ['compress']):
+        response = dashboard.load_hsi_data(1, str(folder), 'npy', 'hwc', None, None, options,
+                                           None, 'cube.npy')
+        handles[tuple(options)] = response[0]['handle']
+
+    assert handles[()] != handles[('compress',)]
+    assert dashboard.get_cube_meta(handles[()])['storage'] == 'npy'
+    assert dashboard.get_cube_meta(handles[('compress',)])['storage'] == 'h5'
+
+
+def test_envi_export_round_trip(tmp_path):
+    cube = np.arange(20 * 30 * 6, dtype=np.uint16).reshape(20, 30, 6)
+    handle = dashboard.register_cube(cube)
+    path = str(tmp_path / 'subcube.zip')
+
+    dashboard.export_envi(path, handle, (2, 12, 5, 25), {'start': 400, 'end': 900})
+
+    with zipfile.ZipFile(path) as archive:
+        archive.extractall(tmp_path)
+    image = spio.envi.open(str(tmp_path / 'subcube.hdr'), str(tmp_path / 'subcube.img'))
+    np.testing.assert_array_equal(np.asarray(image.load()), cube[2:12, 5:25])
+    assert image.metadata['interleave'] == 'bip'
+    assert float(image.metadata['wavelength'][-1]) == 900
+
+
+def test_orientation_maps_clicks_back_to_source():
+    band = np.arange(4 * 7).reshape(4, 7)
+    orientation = dict(dashboard.IDENTITY_ORIENTATION)
+    for op in ('rotate-90', 'vertical-flip', 'rotate-90', 'horizontal-flip', 'rotate-90'):
+        orientation = dashboard.compose_orientation(orientation, op)
+        shown = dashboard.orient_band(band, orientation)
+        assert shown.shape == dashboard.oriented_shape(band.shape, orientation)
+        for y in range(shown.shape[0]):
+            for x in range(shown.shape[1]):
+                assert band[dashboard.to_source_coords(y, x, orientation, band.shape)] == shown[y, x]
+
+
+def test_compose_orientation_matches_applying_ops_in_turn():
+    band = np.arange(3 * 5).reshape(3, 5)
+    ops = {'rotate-90': np.rot90, 'vertical-flip': lambda a: a[::-1],
+           'horizontal-flip': lambda a: a[:, ::-1]}
+    orientation, expected = dashboard.IDENTITY_ORIENTATION, band
+    for op in ('rotate-90', 'vertical-flip', 'rotate-90', 'horizontal-flip'):
+        orientation = dashboard.compose_orientation(orientation, op)
+        expected = ops[op](expected)
+        np.testing.assert_array_equal(dashboard.orient_band(band, orientation), expected)
+
+
+def test_heatmap_sends_8_bit_levels():
+    z = np.linspace(0, 1, 64, dtype=np.float32).reshape(8, 8)
+
+    trace = dashboard.create_band_figure(z, 0, 0, 1, 'light', contrast=2.0,
+                                         brightness=0.1).data[0]
+
+    assert trace.type == 'heatmap' and trace.z.dtype == np.uint8
+    assert trace.z.min() == 0 and trace.z.max() == 255
+    zmin, zmax = dashboard.enhancement_range(2.0, 0.1)
+    assert (trace.zmin, trace.zmax) == pytest.approx((zmin * 255, zmax * 255))
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_subset_and_binning(monkeypatch, lazy):
+    cube = np.random.default_rng(7).random((6, 5, 11)).astype(np.float32)
+    data = cube
+    if lazy:
+        handle = dashboard.register_cube(cube, compression='gzip')
+        monkeypatch.setattr(dashboard, '_cube_registry', {})
+        data = dashboard.get_cube(handle)
+
+    np.testing.assert_array_equal(np.asarray(dashboard.subset_bands(data, 2, 9)),
+                                  cube[:, :, 2:9])
+    binned = dashboard.subset_bands(data, 2, 9, binning=3)
+    expected = np.stack([cube[:, :, 2:5].mean(axis=2), cube[:, :, 5:8].mean(axis=2),
+                         cube[:, :, 8]], axis=2)
+    assert binned.shape == (6, 5, 3)
+    np.testing.assert_allclose(np.asarray(binned), expected, rtol=1e-6)
+    np.testing.assert_allclose(np.asarray(binned[4, 1]), expected[4, 1], rtol=1e-6)
+    assert dashboard.subset_wavelengths({'start': 400, 'end': 900}, 11, 2, 9, 3) == \
+        pytest.approx({'start': 550, 'end': 800})
+
+
+def test_band_range_from_channels_and_wavelengths():
+    wavelengths = {'start': 400, 'end': 900}
+    assert dashboard.resolve_band_range(3, 8, 'channel', None, 11) == (2, 8)
+    assert dashboard.resolve_band_range(None, None, 'channel', None, 11) == (0, 11)
+    assert dashboard.resolve_band_range(500, 700, 'wavelength', wavelengths, 11) == (2, 7)
+    with pytest.raises(ValueError):
+        dashboard.resolve_band_range(8, 3, 'channel', None, 11)
+
+
+def test_update_image_clamps_channel_to_a_smaller_subset(tmp_path):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    np.save(folder / 'cube.npy', np.random.default_rng(8).random((8, 9, 30)).astype(np.float32))
+
+    response = dashboard.load_hsi_data(1, str(folder), 'npy', 'hwc', None, None, [], None,
+                                       'cube.npy', 1, 10)
+    assert response[0]['shape'] == [8, 9, 10]
+
+    _, info, channel, _ = call_callback(
+        dashboard.update_image, 'hsi-data.data', response[0], 25, None, None, 'light')
+    assert channel == 9
+    assert info.startswith('Channel: 10 / 10')
+
+
+def test_similarity_map_matches_sam_and_correlation():
+    cube = np.random.default_rng(9).random((9, 7, 12)).astype(np.float32) + 0.1
+    handle = dashboard.register_cube(cube)
+    reference = cube[3, 4]
+    pixels = cube.reshape(-1, 12).astype(np.float64)
+
+    angles, lo, _ = dashboard.similarity_map(handle, reference, 'sam')
+    cosine = pixels @ reference / (np.linalg.norm(pixels, axis=1) * np.linalg.norm(reference))
+    np.testing.assert_allclose(angles, np.arccos(np.clip(cosine, -1, 1)).reshape(9, 7),
+                               atol=1e-3)
+    assert angles[3, 4] == pytest.approx(0, abs=1e-3) and lo == 0
+
+    corr, lo, hi = dashboard.similarity_map(handle, reference, 'corr')
+    expected = [np.corrcoef(pixel, reference)[0, 1] for pixel in pixels]
+    np.testing.assert_allclose(corr, np.reshape(expected, (9, 7)), atol=1e-5)
+    assert (lo, hi) == (-1, 1)
+
+
+def test_similarity_maps_share_the_band_level_budget(monkeypatch):
+    cube = np.random.default_rng(10).random((16, 16, 4)).astype(np.float32)
+    handle = dashboard.register_cube(cube)
+    monkeypatch.setattr(dashboard, '_band_levels', dashboard.OrderedDict())
+    monkeypatch.setattr(dashboard, '_band_levels_bytes', 0)
+    # Room for two 16 x 16 float32 maps
+    monkeypatch.setattr(dashboard, 'BAND_LEVEL_CACHE_BYTES', 2 * 16 * 16 * 4)
+
+    first = dashboard.similarity_map(handle, cube[0, 0])[0]
+    assert dashboard.similarity_map(handle, cube[0, 0])[0] is first
+    dashboard.get_band_level(handle, 1, 1)
+    dashboard.similarity_map(handle, cube[5, 5])
+
+    assert len(dashboard._band_levels) == 2
+    assert dashboard._band_levels_bytes == 2 * 16 * 16 * 4
+    assert dashboard.similarity_map(handle, cube[0, 0])[0] is not first
+
+
+@pytest.mark.parametrize('kind', ['box', 'lasso'])
+def test_roi_stats_match_the_selected_pixels(kind):
+    cube = np.random.default_rng(11).integers(0, 4000, (12, 10, 5)).astype(np.uint16)
+    handle = dashboard.register_cube(cube)
+    # Displayed (x, y) vertices; the lasso is the lower-left half of the box
+    box = [(1.5, 2.5), (6.2, 2.5), (6.2, 8.1), (1.5, 8.1)]
+    polygon = box if kind == 'box' else [(1.5, 2.5), (1.5, 8.1), (6.2, 8.1)]
+
+    stats = dashboard.compute_roi_stats(handle, kind, polygon)
+
+    ys, xs = np.mgrid[3:9, 2:7]
+    if kind == 'lasso':
+        # Pixel centres below the diagonal from (1.5, 2.5) to (6.2, 8.1)
+        keep = (ys - 2.5) * (6.2 - 1.5) > (xs - 1.5) * (8.1 - 2.5)
+        ys, xs = ys[keep], xs[keep]
+    pixels = cube[ys.ravel(), xs.ravel()].astype(np.float64)
+    assert stats['count'] == len(pixels)
+    np.testing.assert_allclose(stats['mean'], pixels.mean(axis=0))
+    np.testing.assert_allclose(stats['std'], pixels.std(axis=0))
+    np.testing.assert_array_equal(stats['min'], pixels.min(axis=0))
+    np.testing.assert_array_equal(stats['max'], pixels.max(axis=0))
+    np.testing.assert_allclose([stats['p_lo'], stats['p_hi']],
+                               np.percentile(pixels, dashboard.ROI_PERCENTILES, axis=0))
+
+
+def test_roi_stats_outside_the_cube():
+    handle = dashboard.register_cube(np.zeros((4, 4, 2), dtype=np.float32))
+    assert dashboard.compute_roi_stats(handle, 'box', [(5, 5), (8, 5), (8, 8), (5, 8)]) is None
+
+
+def test_quicklook_error_lists_no_outputs(tmp_path):
+    path = tmp_path / 'c.raw'
+    np.zeros(100, dtype=np.uint16).tofile(path)
+
+    result = dashboard.render_quicklook(str(path), 'raw', 'hwc', str(tmp_path / 'out'))
+
+    assert result['error'] and result['outputs'] == {}
+
+
+def test_quicklook_cli_exits_non_zero_when_a_file_fails(tmp_path, capsys):
+    root = tmp_path / 'cubes'
+    root.mkdir()
+    np.save(root / 'a.npy', np.random.default_rng(13).random((8, 9, 5)).astype(np.float32))
+    args = ['quicklook', str(root), '-o', str(tmp_path / 'out'), '-d', 'hwc', '-j', '1']
+
+    assert dashboard.main(args) == 0
+    assert os.path.exists(tmp_path / 'out' / 'a_rgb.png')
+
+    # RAW without a sidecar or --raw-layout
+    np.zeros(100, dtype=np.uint16).tofile(root / 'c.raw')
+    assert dashboard.main(args) == 1
+    assert '"error": null' in capsys.readouterr().out